@@ -1,42 +1,248 @@
 from telethon import TelegramClient
+from telethon.errors import FloodWaitError
 from telethon.tl.types import Message
-import sqlite3
 import asyncio
-import os
 import json
-from datetime import datetime
+import sys
+import time
+from datetime import datetime, timedelta
 from telegram_client import get_client
+from db import connect, init_db, get_state, placeholders, set_state, ROLLUP_COUNTERS
+from peer_cache import load_input_peers, resolve_missing
+from wakeup import ANALYTICS_PORT, listen
 
-# Define Paths
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, "storage.db")
+# How often to refresh a message, by its age. Engagement settles as a post
+# ages, so old messages are polled rarely and messages past the last tier
+# are never re-fetched.
+REFRESH_SCHEDULE = [
+    (timedelta(hours=1), timedelta(minutes=5)),
+    (timedelta(days=1), timedelta(hours=1)),
+    (timedelta(days=7), timedelta(hours=6)),
+    (timedelta(days=30), timedelta(days=1)),
+]
 
-async def update_stats():
+# Scheduled refresh interval of the resident service, in seconds
+SYNC_INTERVAL = 300
+
+# Engagement snapshots older than the age are merged into buckets of the
+# given number of seconds, at most once per DOWNSAMPLE_INTERVAL
+SNAPSHOT_TIERS = [
+    (timedelta(days=2), 3600),
+    (timedelta(days=30), 86400),
+]
+DOWNSAMPLE_INTERVAL = timedelta(days=1)
+
+# get_messages accepts at most 100 ids per request
+GET_MESSAGES_LIMIT = 100
+# Requests in flight at once, before any flood wait shrinks it
+FETCH_CONCURRENCY = 8
+
+class FetchLimiter:
+    """Bounded concurrency that backs off on FloodWaitError.
+
+    A flood wait pauses every fetcher until it expires and halves the number
+    of requests allowed in flight; each clean request grows it back by one.
+    """
+
+    def __init__(self, limit=FETCH_CONCURRENCY):
+        self.max_limit = limit
+        self.limit = limit
+        self.active = 0
+        self.resume_at = 0.0
+        self.cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+        delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def __aexit__(self, *exc):
+        async with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def flood_wait(self, seconds):
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+        self.limit = max(1, self.limit // 2)
+
+    def succeeded(self):
+        self.limit = min(self.max_limit, self.limit + 1)
+
+def fetch_stale_messages(cur):
+    """Rows due for a refresh according to REFRESH_SCHEDULE.
+
+    Each tier only matches messages younger than its age limit whose last
+    refresh is older than the tier's interval; since intervals grow with
+    age, OR-ing the tiers gives every message exactly its own interval.
+    """
+    now = datetime.now()
+    conditions = []
+    params = [(now - REFRESH_SCHEDULE[-1][0]).isoformat()]
+    for max_age, interval in REFRESH_SCHEDULE:
+        conditions.append("(sent_at >= ? AND (last_updated IS NULL OR last_updated < ?))")
+        params += [(now - max_age).isoformat(), (now - interval).isoformat()]
+
+    cur.execute(f"""
+        SELECT id, chat_id, message_id FROM sent_messages
+        WHERE status = 'sent' AND sent_at >= ? AND ({" OR ".join(conditions)})
+    """, params)
+    return cur.fetchall()
+
+async def fetch_chunk(client, limiter, chat_id, peer, msg_ids):
+    while True:
+        async with limiter:
+            try:
+                messages = await client.get_messages(peer, ids=msg_ids)
+                limiter.succeeded()
+                return messages
+            except FloodWaitError as e:
+                print(f"Flood wait of {e.seconds}s while fetching chat {chat_id}")
+                limiter.flood_wait(e.seconds)
+
+async def sync_chat(client, limiter, conn, chat_id, items, peer):
+    # message_id -> sent_messages.id
+    db_ids = {msg_id: db_id for db_id, msg_id in items}
+    msg_ids = list(db_ids)
+
+    try:
+        messages = []
+        for i in range(0, len(msg_ids), GET_MESSAGES_LIMIT):
+            messages += await fetch_chunk(client, limiter, chat_id, peer, msg_ids[i:i + GET_MESSAGES_LIMIT])
+
+        now = datetime.now().isoformat()
+        updates = []
+
+        for msg in messages:
+            if not msg: continue
+            if not isinstance(msg, Message): continue
+
+            # Extract Metrics
+            # Note: views/forwards are often None for private chats, but present for Channels
+            views = getattr(msg, 'views', 0) or 0
+            forwards = getattr(msg, 'forwards', 0) or 0
+
+            # Reactions
+            reaction_count = 0
+            if msg.reactions and msg.reactions.results:
+                reaction_count = sum(r.count for r in msg.reactions.results)
+
+            # Replies / Comments
+            replies_count = 0
+            if msg.replies:
+                replies_count = msg.replies.replies or 0
+
+            db_id = db_ids.pop(msg.id, None)
+            if db_id:
+                updates.append((views, forwards, reaction_count, replies_count, now, db_id))
+
+        conn.executemany("""
+            UPDATE sent_messages 
+            SET views = ?, forwards = ?, reactions = ?, replies = ?, last_updated = ?
+            WHERE id = ?
+        """, updates)
+        # Messages Telegram didn't return still count as refreshed
+        conn.executemany(
+            "UPDATE sent_messages SET last_updated = ? WHERE id = ?",
+            [(now, db_id) for db_id in db_ids.values()]
+        )
+        conn.commit()
+        print(f"Updated {len(updates)} msgs in chat {chat_id}")
+
+    except Exception as e:
+        print(f"Failed to fetch for chat {chat_id}: {e}")
+
+async def sync_chats(client, conn, chat_map, peers=None, concurrency=FETCH_CONCURRENCY):
+    """Refresh every chat in chat_map ({chat_id: [(db_id, msg_id), ...]}) concurrently.
+
+    peers maps chat ids to cached InputPeers; chats without one are passed
+    to Telethon as bare ids.
+    """
+    peers = peers or {}
+    limiter = FetchLimiter(concurrency)
+    await asyncio.gather(*(
+        sync_chat(client, limiter, conn, chat_id, items, peers.get(chat_id, chat_id))
+        for chat_id, items in chat_map.items()
+    ))
+
+def downsample_snapshots(conn):
+    """Merge old engagement snapshots into hourly, then daily buckets.
+
+    Deltas add up, so merging keeps every curve's end points and only
+    loses resolution. Rows already on a bucket boundary are left alone.
+    """
+    now = datetime.now()
+    last = get_state(conn, "snapshots_downsampled")
+    if last and now - datetime.fromisoformat(last) < DOWNSAMPLE_INTERVAL:
+        return
+
+    counters = ", ".join(ROLLUP_COUNTERS)
+    merged = 0
+    with conn:
+        for max_age, bucket in SNAPSHOT_TIERS:
+            cutoff = int((now - max_age).timestamp())
+            where = "ts < ? AND ts % ? != 0"
+            rows = conn.execute(f"""
+                SELECT message_id, ts - ts % ?, {", ".join(f"SUM({c})" for c in ROLLUP_COUNTERS)}
+                FROM engagement_snapshots WHERE {where}
+                GROUP BY 1, 2
+            """, (bucket, cutoff, bucket)).fetchall()
+            merged += conn.execute(f"DELETE FROM engagement_snapshots WHERE {where}", (cutoff, bucket)).rowcount
+            conn.executemany(f"""
+                INSERT INTO engagement_snapshots (message_id, ts, {counters})
+                VALUES (?, ?, {placeholders(ROLLUP_COUNTERS)})
+                ON CONFLICT (message_id, ts) DO UPDATE SET
+                    {", ".join(f"{c} = {c} + excluded.{c}" for c in ROLLUP_COUNTERS)}
+            """, rows)
+        set_state(conn, "snapshots_downsampled", now.isoformat())
+
+    if merged:
+        print(f"Downsampled {merged} engagement snapshots")
+
+async def sync_once(client, conn):
     print("Starting Analytics Sync...")
     
-    # 1. Connect to DB
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    
-    # 2. Fetch Sent Messages that are not deleted
-    # We only care about messages composed by us (status='sent')
-    # Optimally, we filter recent ones or check all. For MVP, check all non-deleted.
-    cur.execute("SELECT id, chat_id, message_id FROM sent_messages WHERE status = 'sent'")
-    rows = cur.fetchall()
+    # Fetch Sent Messages that are due for a refresh
+    # We only care about messages composed by us (status='sent'), and only
+    # the recent ones: see REFRESH_SCHEDULE
+    rows = fetch_stale_messages(conn.cursor())
     
-    if not rows:
-        print("No sent messages to track.")
-        conn.close()
-        return
+    if rows:
+        # Group by chat_id to batch requests
+        chat_map = {}
+        for db_id, chat_id, msg_id in rows:
+            if chat_id not in chat_map:
+                chat_map[chat_id] = []
+            chat_map[chat_id].append((db_id, msg_id))
 
-    # Group by chat_id to batch requests
-    chat_map = {}
-    for db_id, chat_id, msg_id in rows:
-        if chat_id not in chat_map:
-            chat_map[chat_id] = []
-        chat_map[chat_id].append((db_id, msg_id))
+        # Resolve peers from the cache; only unknown chats cost a dialog scan
+        peers = load_input_peers(conn, chat_map)
+        if len(peers) < len(chat_map):
+            print(f"{len(chat_map) - len(peers)} chats not in the peer cache, scanning dialogs...")
+            await resolve_missing(client, conn, [c for c in chat_map if c not in peers])
+            peers = load_input_peers(conn, chat_map)
+
+        print(f"Processing {len(chat_map)} chats...")
+        await sync_chats(client, conn, chat_map, peers)
+    else:
+        print("No messages due for a refresh.")
+
+    set_state(conn, "analytics_last_sync", datetime.now().isoformat())
+    conn.commit()
+    downsample_snapshots(conn)
+    print("Analytics Sync Complete.")
+
+async def run_service(once=False):
+    """Keep one authorized client and refresh on a schedule or on request.
+
+    The Streamlit app asks for a refresh with wakeup.notify(ANALYTICS_PORT).
+    """
+    conn = connect()
+    init_db(conn)
 
-    # 3. Connect Telegram Client
     client = get_client()
     try:
         await client.connect()
@@ -44,63 +250,33 @@ async def update_stats():
             print("Client not authorized. Cannot fetch stats.")
             return
 
-        # Cache Warming: Fetch dialogs so Telethon knows about the entities
-        print("Warming up entity cache...")
-        await client.get_dialogs(limit=100) 
+        if once:
+            await sync_once(client, conn)
+            return
+
+        wake = await listen(ANALYTICS_PORT)
+        print(f"Analytics service running, syncing every {SYNC_INTERVAL}s or on request.")
 
-        print(f"Processing {len(chat_map)} chats...")
-        
-        for chat_id, items in chat_map.items():
-            msg_ids = [m[1] for m in items]
-            
+        while True:
+            # Cleared first so a request arriving mid-sync triggers another pass
+            wake.clear()
             try:
-                # Telethon get_messages allows bulk fetching
-                messages = await client.get_messages(chat_id, ids=msg_ids)
-                
-                for msg in messages:
-                    if not msg: continue
-                    if not isinstance(msg, Message): continue
-                    
-                    # Extract Metrics
-                    # Note: views/forwards are often None for private chats, but present for Channels
-                    views = getattr(msg, 'views', 0) or 0
-                    forwards = getattr(msg, 'forwards', 0) or 0
-                    
-                    # Reactions
-                    reaction_count = 0
-                    if msg.reactions and msg.reactions.results:
-                        reaction_count = sum(r.count for r in msg.reactions.results)
-
-                    # Replies / Comments
-                    replies_count = 0
-                    if msg.replies:
-                        replies_count = msg.replies.replies or 0
-
-                    # Find DB ID
-                    db_id = next((i[0] for i in items if i[1] == msg.id), None)
-                    
-                    if db_id:
-                        cur.execute("""
-                            UPDATE sent_messages 
-                            SET views = ?, forwards = ?, reactions = ?, replies = ?, last_updated = ?
-                            WHERE id = ?
-                        """, (views, forwards, reaction_count, replies_count, datetime.now().isoformat(), db_id))
-                        print(f"Updated Msg {msg.id}: {views} views, {replies_count} replies")
-
-                conn.commit()
-                # Rate limit safety
-                await asyncio.sleep(1) 
-                
+                await sync_once(client, conn)
             except Exception as e:
-                print(f"Failed to fetch for chat {chat_id}: {e}")
+                print(f"Sync Error: {e}")
+
+            try:
+                await asyncio.wait_for(wake.wait(), SYNC_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
 
     except Exception as e:
         print(f"Client Error: {e}")
     finally:
         await client.disconnect()
         conn.close()
-    
-    print("Analytics Sync Complete.")
 
 if __name__ == "__main__":
-    asyncio.run(update_stats())
+    # python analytics_engine.py         -> resident service
+    # python analytics_engine.py --once  -> single sync, then exit
+    asyncio.run(run_service(once="--once" in sys.argv))
@@ -0,0 +1,87 @@
+"""Benchmark the analytics fetcher against a mocked Telethon client.
+
+Usage: python bench_analytics.py [chats] [msgs_per_chat] [latency_ms]
+
+Runs the old serial loop (one chat at a time, 1 s pause between chats)
+and sync_chats on the same throwaway database and prints both timings.
+The mock raises a FloodWaitError now and then to exercise the back-off.
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+from telethon.errors import FloodWaitError
+from telethon.tl.types import Message, PeerChannel
+
+import db
+
+
+class MockClient:
+    def __init__(self, latency, flood_every=0):
+        self.latency = latency
+        self.flood_every = flood_every
+        self.requests = 0
+
+    async def get_messages(self, chat_id, ids):
+        self.requests += 1
+        if len(ids) > 100:
+            raise ValueError("get_messages is limited to 100 ids per request")
+        if self.flood_every and self.requests % self.flood_every == 0:
+            raise FloodWaitError(request=None, capture=1)
+
+        await asyncio.sleep(self.latency)
+        peer = PeerChannel(abs(chat_id))
+        return [Message(id=i, peer_id=peer, views=random.randint(0, 500), forwards=1) for i in ids]
+
+
+async def old_serial_loop(client, chat_map):
+    for chat_id, items in chat_map.items():
+        msg_ids = [m[1] for m in items]
+        for i in range(0, len(msg_ids), 100):
+            await client.get_messages(chat_id, ids=msg_ids[i:i + 100])
+        await asyncio.sleep(1)
+
+
+def main():
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    per_chat = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+    latency = (int(sys.argv[3]) if len(sys.argv) > 3 else 100) / 1000
+
+    db.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    conn = db.connect()
+    db.init_db(conn)
+
+    from analytics_engine import sync_chats
+
+    chat_map = {}
+    db_id = 0
+    for c in range(chats):
+        chat_id = -1000000000000 - c
+        for m in range(1, per_chat + 1):
+            db_id += 1
+            conn.execute(
+                "INSERT INTO sent_messages (id, chat_id, message_id, status) VALUES (?, ?, ?, 'sent')",
+                (db_id, chat_id, m)
+            )
+            chat_map.setdefault(chat_id, []).append((db_id, m))
+    conn.commit()
+
+    print(f"{chats} chats x {per_chat} msgs, {latency * 1000:.0f} ms per request\n")
+
+    start = time.monotonic()
+    asyncio.run(old_serial_loop(MockClient(latency), chat_map))
+    serial = time.monotonic() - start
+    print(f"Serial loop:  {serial:.2f}s")
+
+    start = time.monotonic()
+    asyncio.run(sync_chats(MockClient(latency, flood_every=25), conn, chat_map))
+    parallel = time.monotonic() - start
+    print(f"sync_chats:   {parallel:.2f}s (with a 1 s flood wait every 25 requests)")
+    print(f"Speedup: {serial / parallel:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
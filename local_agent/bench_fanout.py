@@ -0,0 +1,82 @@
+"""Benchmark the fan-out engine against a local fake Bot API server.
+
+Usage: python bench_fanout.py [recipients] [latency_ms] [workers]
+
+Sends to every recipient once with the old serial loop and once with
+FanoutEngine (rate limit lifted so the engine itself is measured), and
+prints the throughput of both.
+"""
+import asyncio
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class FakeBotAPI(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like api.telegram.org
+    latency = 0.05
+    message_ids = itertools.count(1)
+    received = []
+
+    def do_POST(self):
+        self.received.append(time.monotonic())
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+
+        body = json.dumps({
+            "ok": True,
+            "result": {"message_id": next(self.message_ids)}
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(latency):
+    FakeBotAPI.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeBotAPI)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    latency = (int(sys.argv[2]) if len(sys.argv) > 2 else 50) / 1000
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+
+    server = start_server(latency)
+    os.environ["TELEGRAM_API_ROOT"] = f"http://127.0.0.1:{server.server_port}"
+
+    # Imported after the env var is set so API_ROOT points at the fake server
+    from bot_message_sender import send_text
+    from fanout import FanoutEngine
+
+    recipients = list(range(1, count + 1))
+    print(f"{count} recipients, {latency * 1000:.0f} ms simulated API latency\n")
+
+    start = time.monotonic()
+    for chat_id in recipients:
+        send_text(chat_id, "benchmark")
+    serial = time.monotonic() - start
+    print(f"Serial loop: {serial:.2f}s ({count / serial:.1f} msg/s)")
+
+    engine = FanoutEngine(workers=workers, global_rate=None)
+    stats = asyncio.run(engine.run(recipients, lambda chat_id: send_text(chat_id, "benchmark")))
+    engine.shutdown()
+    print(f"Speedup: {serial / stats['elapsed']:.1f}x with {workers} workers")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
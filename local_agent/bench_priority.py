@@ -0,0 +1,76 @@
+"""Measure urgent-send latency while a bulk broadcast is running.
+
+Usage: python bench_priority.py [bulk_recipients] [urgent_tasks]
+
+Starts a bulk broadcast against a local fake Bot API server under the
+real global rate limit, then fires small 20-chat urgent tasks while it
+runs. Each urgent send is timed from its task's start to the API reply.
+Runs once with the urgent tasks in the urgent lane and once with them in
+the bulk lane too, where only the per-task round robin applies.
+Sending the tasks one after another, as the daemon used to, would make
+every urgent task wait for the whole bulk broadcast.
+"""
+import asyncio
+import os
+import sys
+import time
+
+from bench_fanout import start_server
+
+URGENT_SIZE = 20
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def scenario(engine, send_text, bulk, urgent_tasks, urgent_lane):
+    latencies = []
+
+    async def urgent(start_id):
+        start = time.monotonic()
+
+        def on_result(chat_id, response):
+            latencies.append(time.monotonic() - start)
+
+        recipients = range(start_id, start_id + URGENT_SIZE)
+        await engine.run(recipients, lambda chat_id: send_text(chat_id, "alert"), on_result, urgent_lane)
+
+    bulk_run = asyncio.create_task(
+        engine.run(range(1, bulk + 1), lambda chat_id: send_text(chat_id, "newsletter"), lane="bulk")
+    )
+    await asyncio.sleep(1)
+    for i in range(urgent_tasks):
+        await urgent(1_000_000 + i * URGENT_SIZE)
+        await asyncio.sleep(0.5)
+    await bulk_run
+    return latencies
+
+
+def main():
+    bulk = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    urgent_tasks = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    server = start_server(0.02)
+    os.environ["TELEGRAM_API_ROOT"] = f"http://127.0.0.1:{server.server_port}"
+
+    # Imported after the env var is set so API_ROOT points at the fake server
+    from bot_message_sender import send_text
+    from fanout import FanoutEngine
+
+    print(f"Bulk broadcast to {bulk} chats, {urgent_tasks} urgent tasks of {URGENT_SIZE} chats\n")
+    for lane in ("urgent", "bulk"):
+        engine = FanoutEngine()
+        latencies = asyncio.run(scenario(engine, send_text, bulk, urgent_tasks, lane))
+        engine.shutdown()
+        print(
+            f"Urgent tasks in the {lane} lane: "
+            f"p50 {percentile(latencies, 50):.2f}s, p99 {percentile(latencies, 99):.2f}s"
+        )
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import os
+import random
+import threading
+import time
+import requests
+
+from bot_config import BOT_TOKENS
+
+API_ROOT = os.getenv("TELEGRAM_API_ROOT", "https://api.telegram.org")
+
+# Bots by their Telegram user id (the part of the token before the colon)
+BOTS = {int(token.split(":")[0]): token for token in BOT_TOKENS}
+# Sends without a bot, and messages recorded before the pool, use the first
+PRIMARY_BOT = next(iter(BOTS))
+
+# (connect, read) seconds; uploads get a longer read timeout
+TIMEOUT = (5, 30)
+UPLOAD_TIMEOUT = (5, 120)
+
+MAX_RETRIES = 3
+BACKOFF_SECONDS = 0.5
+# A 429 asking for a longer pause is returned to the caller instead of slept on
+MAX_RETRY_AFTER = 60
+
+# A send that timed out or got a 5xx may still have been delivered, so
+# these are retried only when the request never reached Telegram, and
+# such a reply is flagged "unknown" for the caller
+SEND_METHODS = {"sendMessage", "sendPhoto", "sendDocument", "sendPoll"}
+
+# One keep-alive session shared by every sender (and every fan-out worker thread)
+session = requests.Session()
+session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32))
+session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+# ---------- METRICS ----------
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+def record(method, seconds, error=False, retried=False, rate_limited=False):
+    with _metrics_lock:
+        m = _metrics.setdefault(method, {
+            "calls": 0, "errors": 0, "retries": 0, "rate_limited": 0,
+            "total_seconds": 0.0, "max_seconds": 0.0
+        })
+        m["calls"] += 1
+        m["errors"] += error
+        m["retries"] += retried
+        m["rate_limited"] += rate_limited
+        m["total_seconds"] += seconds
+        m["max_seconds"] = max(m["max_seconds"], seconds)
+
+def metrics():
+    """{method: counters} for every method called so far, with avg_ms / max_ms."""
+    with _metrics_lock:
+        snapshot = {method: dict(m) for method, m in _metrics.items()}
+    for m in snapshot.values():
+        m["avg_ms"] = 1000 * m["total_seconds"] / m["calls"] if m["calls"] else 0.0
+        m["max_ms"] = 1000 * m["max_seconds"]
+    return snapshot
+
+def print_metrics():
+    for method, m in sorted(metrics().items()):
+        print(
+            f"Bot API {method}: {m['calls']} calls, {m['errors']} errors, "
+            f"{m['retries']} retries, {m['rate_limited']} rate limited, "
+            f"avg {m['avg_ms']:.0f} ms, max {m['max_ms']:.0f} ms"
+        )
+
+# ---------- CALLS ----------
+def call(method, payload=None, files=None, timeout=TIMEOUT, bot_id=None):
+    """POST a Bot API method as bot_id (default PRIMARY_BOT) and return the decoded response.
+
+    Connection errors, timeouts and 5xx are retried with exponential
+    backoff, and 429s after the retry_after Telegram asks for. Sends
+    (SEND_METHODS) are only retried on connection errors and 429s, so a
+    recipient doesn't get a message twice; a send's read timeout or 5xx
+    comes back as an {"ok": false, "unknown": true, ...} reply, as it
+    may have gone out. Other errors come back as the API's
+    {"ok": false, ...} reply. Raises the last network error once retries
+    run out.
+    """
+    url = f"{API_ROOT}/bot{BOTS[bot_id or PRIMARY_BOT]}/{method}"
+    is_send = method in SEND_METHODS
+    # ConnectTimeout is a ConnectionError too
+    retry_on = requests.ConnectionError if is_send else (requests.ConnectionError, requests.Timeout)
+    for attempt in range(MAX_RETRIES + 1):
+        last_try = attempt == MAX_RETRIES
+        if files:
+            # Rewind uploads before a retry
+            for f in files.values():
+                f.seek(0)
+
+        start = time.monotonic()
+        try:
+            if files:
+                r = session.post(url, data=payload, files=files, timeout=timeout)
+            else:
+                r = session.post(url, json=payload, timeout=timeout)
+        except retry_on:
+            record(method, time.monotonic() - start, error=True, retried=not last_try)
+            if last_try:
+                raise
+            time.sleep(BACKOFF_SECONDS * 2 ** attempt * (1 + random.random()))
+            continue
+        except requests.Timeout as e:
+            # A send's read timeout: it may have gone out
+            record(method, time.monotonic() - start, error=True)
+            return {"ok": False, "error_code": 0, "description": f"Read timed out: {e}", "unknown": True}
+        elapsed = time.monotonic() - start
+
+        try:
+            result = r.json()
+        except ValueError:
+            result = {"ok": False, "error_code": r.status_code, "description": r.text[:200]}
+
+        if r.status_code == 429:
+            retry_after = result.get("parameters", {}).get("retry_after", 1)
+            can_wait = not last_try and retry_after <= MAX_RETRY_AFTER
+            record(method, elapsed, error=True, retried=can_wait, rate_limited=True)
+            if not can_wait:
+                return result
+            print(f"Bot API {method} rate limited, retrying in {retry_after}s")
+            time.sleep(retry_after)
+            continue
+
+        if r.status_code >= 500:
+            if is_send:
+                result["unknown"] = True
+            elif not last_try:
+                record(method, elapsed, error=True, retried=True)
+                time.sleep(BACKOFF_SECONDS * 2 ** attempt * (1 + random.random()))
+                continue
+
+        record(method, elapsed, error=not result.get("ok"))
+        return result
@@ -1 +1,7 @@
+import os
+
 BOT_TOKEN = "8256718800:AAGGLyn_aSxg3aVruamFOL6mb0ZrVo3mhbU"
+
+# Broadcast bot pool: BOT_TOKENS="token1,token2,..." in the environment.
+# Each bot has its own rate limits; chats stick to the bot that reaches them.
+BOT_TOKENS = [t.strip() for t in os.getenv("BOT_TOKENS", "").split(",") if t.strip()] or [BOT_TOKEN]
@@ -1,59 +1,57 @@
-import requests
 import os
+from bot_api import call, UPLOAD_TIMEOUT
 
-BOT_TOKEN = "8256718800:AAGGLyn_aSxg3aVruamFOL6mb0ZrVo3mhbU"
-BASE_URL = f"https://api.telegram.org/bot{BOT_TOKEN}"
+# bot_id picks the pool bot to send as; None is the primary bot.
+# Deletes must use the bot that sent the message.
 
-def send_text(chat_id, text):
-    r = requests.post(
-        f"{BASE_URL}/sendMessage",
-        json={"chat_id": chat_id, "text": text}
-    )
-    return r.json()
+def send_text(chat_id, text, bot_id=None):
+    return call("sendMessage", {"chat_id": chat_id, "text": text}, bot_id=bot_id)
 
-def delete_message(chat_id, message_id):
-    r = requests.post(
-        f"{BASE_URL}/deleteMessage",
-        json={"chat_id": chat_id, "message_id": message_id}
-    )
-    return r.json()
+def delete_message(chat_id, message_id, bot_id=None):
+    return call("deleteMessage", {"chat_id": chat_id, "message_id": message_id}, bot_id=bot_id)
+
+def delete_messages(chat_id, message_ids, bot_id=None):
+    # Bot API accepts up to 100 ids per call
+    return call("deleteMessages", {"chat_id": chat_id, "message_ids": message_ids}, bot_id=bot_id)
+
+def send_photo(chat_id, file_path, caption=None, file_id=None, bot_id=None):
+    # Re-send an already uploaded photo by its Telegram file_id (file_ids are per bot)
+    if file_id:
+        return call("sendPhoto", {"chat_id": chat_id, "photo": file_id, "caption": caption or ""}, bot_id=bot_id)
 
-def send_photo(chat_id, file_path, caption=None):
     if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
         print(f"Photo file missing or empty: {file_path}")
         return
 
     with open(file_path, "rb") as photo:
-        response = requests.post(
-            f"{BASE_URL}/sendPhoto",
-            data={
-                "chat_id": chat_id,
-                "caption": caption or ""
-            },
-            files={
-                "photo": photo
-            },
-            timeout=60
+        response = call(
+            "sendPhoto",
+            {"chat_id": chat_id, "caption": caption or ""},
+            files={"photo": photo},
+            timeout=UPLOAD_TIMEOUT,
+            bot_id=bot_id
         )
 
-    print("PHOTO RESPONSE:", response.text)
+    print("PHOTO RESPONSE:", response)
+    return response
+
+def send_document(chat_id, file_path, caption=None, file_id=None, bot_id=None):
+    # Re-send an already uploaded document by its Telegram file_id (file_ids are per bot)
+    if file_id:
+        return call("sendDocument", {"chat_id": chat_id, "document": file_id, "caption": caption or ""}, bot_id=bot_id)
 
-def send_document(chat_id, file_path, caption=None):
     if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
         print(f"Document file missing or empty: {file_path}")
         return
 
     with open(file_path, "rb") as doc:
-        response = requests.post(
-            f"{BASE_URL}/sendDocument",
-            data={
-                "chat_id": chat_id,
-                "caption": caption or ""
-            },
-            files={
-                "document": doc
-            },
-            timeout=60
+        response = call(
+            "sendDocument",
+            {"chat_id": chat_id, "caption": caption or ""},
+            files={"document": doc},
+            timeout=UPLOAD_TIMEOUT,
+            bot_id=bot_id
         )
 
-    print("DOC RESPONSE:", response.text)
+    print("DOC RESPONSE:", response)
+    return response
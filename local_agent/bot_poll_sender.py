@@ -1,10 +1,6 @@
+from bot_api import call
 
-import requests
-
-BOT_TOKEN = "8256718800:AAGGLyn_aSxg3aVruamFOL6mb0ZrVo3mhbU"
-BASE_URL = f"https://api.telegram.org/bot{BOT_TOKEN}"
-
-def send_poll(chat_id, question, options, correct):
+def send_poll(chat_id, question, options, correct, bot_id=None):
     payload = {
         "chat_id": chat_id,
         "question": question,
@@ -14,4 +10,4 @@ def send_poll(chat_id, question, options, correct):
         "is_anonymous": True
     }
 
-    requests.post(f"{BASE_URL}/sendPoll", json=payload)
+    return call("sendPoll", payload, bot_id=bot_id)
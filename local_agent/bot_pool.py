@@ -0,0 +1,49 @@
+from collections import Counter
+
+from bot_api import BOTS, PRIMARY_BOT
+from db import placeholders
+
+# Chats looked up per query (SQLite caps bound parameters)
+LOOKUP_CHUNK = 500
+
+
+def chat_bots(conn, chat_ids):
+    """{chat_id: bot_id} for chats already reached through a bot still in the pool."""
+    chat_ids = list(chat_ids)
+    known = {}
+    for i in range(0, len(chat_ids), LOOKUP_CHUNK):
+        chunk = chat_ids[i:i + LOOKUP_CHUNK]
+        known.update(conn.execute(
+            f"SELECT chat_id, bot_id FROM chat_bots WHERE chat_id IN ({placeholders(chunk)})", chunk
+        ).fetchall())
+    # NULL is the primary bot, from before the pool
+    known = {chat_id: bot_id or PRIMARY_BOT for chat_id, bot_id in known.items()}
+    return {chat_id: bot_id for chat_id, bot_id in known.items() if bot_id in BOTS}
+
+
+def plan_routes(conn, recipients):
+    """{chat_id: [bot_id, ...]}, the bots to try for each chat in order.
+
+    A chat sticks to the bot that reached it before. New chats go to the
+    bot with the fewest chats in this broadcast. Either way the rest of
+    the pool follows as fallbacks in case that bot is not (or no longer) a
+    member there; chat_bots then moves to the bot that got through.
+    """
+    known = chat_bots(conn, recipients)
+    load = Counter(known.values())
+    routes = {}
+    for chat_id in recipients:
+        bot_id = known.get(chat_id)
+        if bot_id is None:
+            bot_id = min(BOTS, key=lambda b: load[b])
+            load[bot_id] += 1
+        routes[chat_id] = [bot_id] + [b for b in BOTS if b != bot_id]
+    return routes
+
+
+def not_member(response):
+    """True if the reply means this bot can't post in the chat (kicked, never added, not started)."""
+    if not response or response.get("ok"):
+        return False
+    code = response.get("error_code")
+    return code == 403 or (code == 400 and "chat not found" in (response.get("description") or "").lower())
@@ -1,31 +1,24 @@
-import asyncio
 import json
 import os
-from telegram import Bot
+import sys
 
-BOT_TOKEN = os.getenv("BOT_TOKEN") or "PASTE_YOUR_BOT_TOKEN"
+from bot_poll_sender import send_poll
 
-async def send_quiz(task_file):
+def send_quiz(task_file):
     with open(task_file, "r", encoding="utf-8") as f:
         task = json.load(f)
 
-    bot = Bot(token=BOT_TOKEN)
-
     quiz = task["content"]
 
+    # Same Bot API path and retries as the daemon's quiz jobs
     for chat_id in task["recipients"]:
-        await bot.send_poll(
-            chat_id=chat_id,
-            question=quiz["question"],
-            options=quiz["options"],
-            type="quiz",
-            correct_option_id=quiz["correct"],
-            is_anonymous=False
-        )
-        print(f"Quiz sent to {chat_id}")
+        response = send_poll(chat_id, quiz["question"], quiz["options"], quiz["correct"])
+        if response.get("ok"):
+            print(f"Quiz sent to {chat_id}")
+        else:
+            print(f"Quiz to {chat_id} failed: {response.get('description')}")
 
     os.remove(task_file)
 
 if __name__ == "__main__":
-    import sys
-    asyncio.run(send_quiz(sys.argv[1]))
+    send_quiz(sys.argv[1])
@@ -0,0 +1,496 @@
+import os
+import sqlite3
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(BASE_DIR, "storage.db")
+
+
+def connect(check_same_thread=True):
+    conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=check_same_thread)
+    # WAL lets the app read while the daemon writes, and is persistent on the file
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def add_column(conn, table, column):
+    try:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+    except sqlite3.OperationalError:
+        pass  # already there
+
+
+def placeholders(values):
+    """"?,?,?" for an IN (...) or VALUES list of len(values) parameters."""
+    return ",".join("?" * len(values))
+
+
+def migrate_v1(conn):
+    # Everything from before the schema was versioned. Databases created by
+    # older app / daemon versions already have parts of it, so every step
+    # must be safe to re-run.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS folders (
+            name TEXT PRIMARY KEY
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS folder_entities (
+            folder TEXT,
+            entity_id INTEGER,
+            label TEXT
+        )
+    """)
+
+    # Message Logs with task_name
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS message_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id TEXT,
+            task_name TEXT,
+            task_type TEXT,
+            folders TEXT,
+            recipients INTEGER,
+            has_media INTEGER,
+            created_at TEXT
+        )
+    """)
+    add_column(conn, "message_logs", "task_name TEXT")
+
+    # Sent Messages for tracking IDs
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sent_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id TEXT,
+            chat_id INTEGER,
+            message_id INTEGER,
+            sent_at TEXT,
+            status TEXT,
+            views INTEGER DEFAULT 0,
+            forwards INTEGER DEFAULT 0,
+            reactions INTEGER DEFAULT 0,
+            replies INTEGER DEFAULT 0,
+            last_updated TEXT,
+            expires_at TEXT
+        )
+    """)
+    for column in [
+        "views INTEGER DEFAULT 0",
+        "forwards INTEGER DEFAULT 0",
+        "reactions INTEGER DEFAULT 0",
+        "replies INTEGER DEFAULT 0",
+        "last_updated TEXT",
+        "expires_at TEXT",
+    ]:
+        add_column(conn, "sent_messages", column)
+
+    # Analytics only looks at recent live messages
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sent_messages_sent_at ON sent_messages (status, sent_at)")
+    # Temporary messages waiting for the expiry sweeper
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_sent_messages_expiry
+        ON sent_messages (expires_at) WHERE status = 'sent'
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS media_cache (
+            file_hash TEXT,
+            file_type TEXT,
+            file_id TEXT,
+            created_at TEXT,
+            PRIMARY KEY (file_hash, file_type)
+        )
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            type TEXT,
+            payload TEXT,
+            send_at TEXT,
+            status TEXT DEFAULT 'pending',
+            error TEXT,
+            created_at TEXT,
+            updated_at TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs (status, send_at)")
+
+    # Telegram peers, so Telethon can build InputPeers without get_dialogs
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS entities (
+            id INTEGER PRIMARY KEY,
+            access_hash INTEGER,
+            peer_type TEXT,
+            name TEXT,
+            username TEXT,
+            type TEXT,
+            updated_at TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_entities_name ON entities (name COLLATE NOCASE)")
+
+    # Small key/value store for sync bookkeeping
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+
+
+def migrate_v2(conn):
+    # Full-text index over entity names for the Folder Manager search,
+    # kept in sync with the entities table by triggers
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS entities_fts USING fts5(
+                name, username,
+                content='entities', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+    except sqlite3.OperationalError:
+        return  # SQLite built without FTS5: search falls back to name prefixes
+
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS entities_fts_insert AFTER INSERT ON entities BEGIN
+            INSERT INTO entities_fts (rowid, name, username) VALUES (new.id, new.name, new.username);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS entities_fts_delete AFTER DELETE ON entities BEGIN
+            INSERT INTO entities_fts (entities_fts, rowid, name, username)
+            VALUES ('delete', old.id, old.name, old.username);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS entities_fts_update AFTER UPDATE OF name, username ON entities BEGIN
+            INSERT INTO entities_fts (entities_fts, rowid, name, username)
+            VALUES ('delete', old.id, old.name, old.username);
+            INSERT INTO entities_fts (rowid, name, username) VALUES (new.id, new.name, new.username);
+        END
+    """)
+    conn.execute("INSERT INTO entities_fts (entities_fts) VALUES ('rebuild')")
+
+
+def migrate_v3(conn):
+    # One row per (folder, entity): rebuild folder_entities with a primary
+    # key, dropping duplicates left by the old delete-and-reinsert saves
+    conn.execute("""
+        CREATE TABLE folder_entities_new (
+            folder TEXT,
+            entity_id INTEGER,
+            label TEXT,
+            PRIMARY KEY (folder, entity_id)
+        )
+    """)
+    conn.execute("""
+        INSERT OR IGNORE INTO folder_entities_new (folder, entity_id, label)
+        SELECT folder, entity_id, label FROM folder_entities
+        WHERE folder IS NOT NULL AND entity_id IS NOT NULL
+    """)
+    conn.execute("DROP TABLE folder_entities")
+    conn.execute("ALTER TABLE folder_entities_new RENAME TO folder_entities")
+    # Which folders is this entity in
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_folder_entities_entity ON folder_entities (entity_id)")
+
+
+def migrate_v4(conn):
+    # Message History pages newest first, optionally by type
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_message_logs_created ON message_logs (created_at, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_message_logs_type ON message_logs (task_type, created_at, id)")
+
+    # message_logs.folders is a comma list; this maps each log to its folders
+    # so the folder filter is an index lookup instead of a LIKE scan
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS message_log_folders (
+            folder TEXT,
+            log_id INTEGER,
+            PRIMARY KEY (folder, log_id)
+        )
+    """)
+    rows = conn.execute("SELECT id, folders FROM message_logs WHERE folders IS NOT NULL AND folders != ''")
+    conn.executemany(
+        "INSERT OR IGNORE INTO message_log_folders (folder, log_id) VALUES (?, ?)",
+        [(folder, log_id) for log_id, folders in rows.fetchall() for folder in folders.split(",")]
+    )
+
+
+# Rollups kept by triggers on sent_messages: (table, key column, key expression)
+ROLLUPS = [
+    ("task_stats", "task_id", "COALESCE({row}.task_id, '')"),
+    ("daily_stats", "day", "COALESCE(substr({row}.sent_at, 1, 10), '')"),
+]
+ROLLUP_COUNTERS = ["views", "forwards", "reactions", "replies"]
+
+
+def rollup_upsert(table, key, key_expr, row, sign):
+    """Add (sign=+1) or remove (-1) one sent_messages row from a rollup."""
+    values = [key_expr.format(row=row), f"{row}.status", f"{sign}"]
+    values += [f"{sign} * COALESCE({row}.{c}, 0)" for c in ROLLUP_COUNTERS]
+    columns = ["messages"] + ROLLUP_COUNTERS
+    return f"""
+        INSERT INTO {table} ({key}, status, {", ".join(columns)})
+        VALUES ({", ".join(values)})
+        ON CONFLICT ({key}, status) DO UPDATE SET
+            {", ".join(f"{c} = {c} + excluded.{c}" for c in columns)};
+    """
+
+
+def migrate_v5(conn):
+    # Per-task and per-day totals for the Dashboard, by message status, so it
+    # reads O(tasks) / O(days) rows instead of scanning sent_messages
+    counters = ", ".join(f"{c} INTEGER DEFAULT 0" for c in ROLLUP_COUNTERS)
+    for table, key, key_expr in ROLLUPS:
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                {key} TEXT,
+                status TEXT,
+                messages INTEGER DEFAULT 0,
+                {counters},
+                PRIMARY KEY ({key}, status)
+            )
+        """)
+        conn.execute(f"DELETE FROM {table}")
+        conn.execute(f"""
+            INSERT INTO {table} ({key}, status, messages, {", ".join(ROLLUP_COUNTERS)})
+            SELECT {key_expr.format(row="sent_messages")}, status, COUNT(*),
+                   {", ".join(f"COALESCE(SUM({c}), 0)" for c in ROLLUP_COUNTERS)}
+            FROM sent_messages GROUP BY 1, 2
+        """)
+
+    add = "".join(rollup_upsert(t, k, e, "new", 1) for t, k, e in ROLLUPS)
+    remove = "".join(rollup_upsert(t, k, e, "old", -1) for t, k, e in ROLLUPS)
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS sent_messages_rollup_insert AFTER INSERT ON sent_messages BEGIN {add} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS sent_messages_rollup_delete AFTER DELETE ON sent_messages BEGIN {remove} END")
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS sent_messages_rollup_update
+        AFTER UPDATE OF task_id, sent_at, status, {", ".join(ROLLUP_COUNTERS)} ON sent_messages
+        BEGIN {remove} {add} END
+    """)
+
+    # Undo / per-task lookups, and the daemon's status updates
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sent_messages_task ON sent_messages (task_id, status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sent_messages_chat ON sent_messages (chat_id, message_id)")
+
+
+def migrate_v6(conn):
+    # Engagement history: one row per message per sync that changed a
+    # counter, holding only the increments. ts is unix seconds (UTC) and a
+    # message's curve is the running sum of its rows.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS engagement_snapshots (
+            message_id INTEGER,
+            ts INTEGER,
+            views INTEGER,
+            forwards INTEGER,
+            reactions INTEGER,
+            replies INTEGER,
+            PRIMARY KEY (message_id, ts)
+        ) WITHOUT ROWID
+    """)
+
+    # Current totals become each message's first snapshot
+    conn.execute("""
+        INSERT OR IGNORE INTO engagement_snapshots
+        SELECT id, CAST(strftime('%s', COALESCE(last_updated, sent_at), 'utc') AS INTEGER),
+               COALESCE(views, 0), COALESCE(forwards, 0), COALESCE(reactions, 0), COALESCE(replies, 0)
+        FROM sent_messages
+        WHERE COALESCE(views, 0) + COALESCE(forwards, 0) + COALESCE(reactions, 0) + COALESCE(replies, 0) > 0
+          AND COALESCE(last_updated, sent_at) IS NOT NULL
+    """)
+
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS sent_messages_engagement
+        AFTER UPDATE OF {", ".join(ROLLUP_COUNTERS)} ON sent_messages
+        WHEN {" OR ".join(f"new.{c} IS NOT old.{c}" for c in ROLLUP_COUNTERS)}
+        BEGIN
+            INSERT INTO engagement_snapshots (message_id, ts, {", ".join(ROLLUP_COUNTERS)})
+            VALUES (
+                new.id, CAST(strftime('%s', 'now') AS INTEGER),
+                {", ".join(f"COALESCE(new.{c}, 0) - COALESCE(old.{c}, 0)" for c in ROLLUP_COUNTERS)}
+            )
+            ON CONFLICT (message_id, ts) DO UPDATE SET
+                {", ".join(f"{c} = {c} + excluded.{c}" for c in ROLLUP_COUNTERS)};
+        END
+    """)
+
+
+def migrate_v7(conn):
+    # Per-recipient delivery state of each job:
+    # pending -> sent / failed, or pending -> retrying -> ... -> sent / failed
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS deliveries (
+            job_id TEXT,
+            chat_id INTEGER,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            message_id INTEGER,
+            error TEXT,
+            next_attempt_at TEXT,
+            updated_at TEXT,
+            PRIMARY KEY (job_id, chat_id)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_deliveries_status ON deliveries (job_id, status)")
+
+
+def migrate_v8(conn):
+    # Quizzes are tracked in sent_messages too; each send is its own poll
+    add_column(conn, "sent_messages", "poll_id TEXT")
+
+    # Latest vote count of every option of every poll we sent, from the
+    # bot's poll updates
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS poll_votes (
+            poll_id TEXT,
+            option INTEGER,
+            votes INTEGER,
+            PRIMARY KEY (poll_id, option)
+        ) WITHOUT ROWID
+    """)
+
+
+def migrate_v9(conn):
+    # Priority lane of a job: urgent, normal or bulk
+    add_column(conn, "jobs", "priority TEXT DEFAULT 'normal'")
+
+
+def migrate_v10(conn):
+    # Jobs are leased by a worker process, which renews the lease while it
+    # runs the job; an expired lease means the worker died
+    add_column(conn, "jobs", "worker_id TEXT")
+    add_column(conn, "jobs", "lease_until TEXT")
+    # Running jobs of a pre-lease daemon have no lease to expire
+    conn.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS workers (
+            id TEXT PRIMARY KEY,
+            host TEXT,
+            pid INTEGER,
+            started_at TEXT,
+            heartbeat_at TEXT
+        )
+    """)
+
+    # Named singleton duties (expiry sweep, poll collector) held by one worker
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            worker_id TEXT,
+            lease_until TEXT
+        )
+    """)
+
+
+def migrate_v11(conn):
+    # Which pool bot sent each message; deletes must come from the same bot.
+    # NULL (older rows) means the primary bot.
+    add_column(conn, "sent_messages", "bot_id INTEGER")
+
+    # The bot each chat is reached through
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS chat_bots (
+            chat_id INTEGER PRIMARY KEY,
+            bot_id INTEGER,
+            updated_at TEXT
+        )
+    """)
+    # Chats messaged before the pool were reached by the primary bot (NULL)
+    conn.execute("""
+        INSERT OR IGNORE INTO chat_bots (chat_id, bot_id, updated_at)
+        SELECT chat_id, NULL, MAX(sent_at) FROM sent_messages GROUP BY chat_id
+    """)
+
+    # file_ids only work for the bot that uploaded the file; entries from
+    # before the pool are dropped and re-uploaded once
+    conn.execute("DROP TABLE IF EXISTS media_cache")
+    conn.execute("""
+        CREATE TABLE media_cache (
+            file_hash TEXT,
+            file_type TEXT,
+            bot_id INTEGER,
+            file_id TEXT,
+            created_at TEXT,
+            PRIMARY KEY (file_hash, file_type, bot_id)
+        )
+    """)
+
+
+def migrate_v12(conn):
+    # Account a job sends as: "bot" (the Bot API pool) or "userbot"
+    add_column(conn, "jobs", "backend TEXT DEFAULT 'bot'")
+
+
+def migrate_v13(conn):
+    # Recurring broadcasts; schedular.fire_due enqueues a job per run
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schedules (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            task TEXT,
+            kind TEXT,
+            spec TEXT,
+            next_run_at TEXT,
+            last_run_at TEXT,
+            enabled INTEGER DEFAULT 1,
+            created_at TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_schedules_due
+        ON schedules (next_run_at) WHERE enabled = 1
+    """)
+
+
+# Schema version N is reached by running MIGRATIONS[N - 1]. Only ever
+# append to this list; released steps must not change.
+MIGRATIONS = [
+    migrate_v1,
+    migrate_v2,
+    migrate_v3,
+    migrate_v4,
+    migrate_v5,
+    migrate_v6,
+    migrate_v7,
+    migrate_v8,
+    migrate_v9,
+    migrate_v10,
+    migrate_v11,
+    migrate_v12,
+    migrate_v13,
+]
+
+
+def init_db(conn):
+    """Bring the schema up to date. A single PRAGMA read once it is."""
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= len(MIGRATIONS):
+        return
+
+    # Serialize with other processes migrating at the same time
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for step in MIGRATIONS[version:]:
+            step(conn)
+            version += 1
+            print(f"Database schema migrated to v{version}")
+        conn.execute(f"PRAGMA user_version = {version}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def get_state(conn, key, default=None):
+    row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_state(conn, key, value):
+    """Set (or with value=None, clear) a sync_state key. The caller commits."""
+    if value is None:
+        conn.execute("DELETE FROM sync_state WHERE key = ?", (key,))
+    else:
+        conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
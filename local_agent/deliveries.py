@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+
+# A recipient is given up on after this many failed attempts
+MAX_ATTEMPTS = 5
+# Wait before retry N (seconds); the last value repeats
+RETRY_BACKOFF = [30, 120, 600, 1800]
+
+
+def start(conn, job_id, recipients):
+    """Create a pending delivery per recipient. A no-op for a resumed job."""
+    now = datetime.now().isoformat()
+    conn.executemany("""
+        INSERT OR IGNORE INTO deliveries (job_id, chat_id, status, updated_at)
+        VALUES (?, ?, 'pending', ?)
+    """, [(job_id, chat_id, now) for chat_id in dict.fromkeys(recipients)])
+    conn.commit()
+
+
+def due_recipients(conn, job_id):
+    """{chat_id: attempts so far} for deliveries waiting to be sent now."""
+    return dict(conn.execute("""
+        SELECT chat_id, attempts FROM deliveries
+        WHERE job_id = ? AND (
+            status = 'pending' OR (status = 'retrying' AND next_attempt_at <= ?)
+        )
+    """, (job_id, datetime.now().isoformat())).fetchall())
+
+
+def next_retry_at(conn, job_id):
+    row = conn.execute(
+        "SELECT MIN(next_attempt_at) FROM deliveries WHERE job_id = ? AND status = 'retrying'",
+        (job_id,)
+    ).fetchone()
+    return datetime.fromisoformat(row[0]) if row[0] else None
+
+
+def counts(conn, job_id):
+    return dict(conn.execute(
+        "SELECT status, COUNT(*) FROM deliveries WHERE job_id = ? GROUP BY status", (job_id,)
+    ).fetchall())
+
+
+def outcome(response, attempts):
+    """(status, message_id, error, next_attempt_at) for one send's response.
+
+    Sends that never reached Telegram (no response) and 429s are retried
+    later. A read timeout or 5xx ("unknown") may have been delivered, so
+    it fails the recipient rather than risk a second copy, like any other
+    API error (blocked by the user, chat not found...).
+    """
+    if response and response.get("ok"):
+        result = response.get("result")
+        message_id = result.get("message_id") if isinstance(result, dict) else None
+        return "sent", message_id, None, None
+
+    if response:
+        code = response.get("error_code") or 0
+        error = response.get("description") or f"error {code}"
+        if response.get("unknown"):
+            error = f"delivery unknown: {error}"
+        retryable = code == 429
+    else:
+        error = "no response"
+        retryable = True
+
+    attempts += 1
+    if not retryable or attempts >= MAX_ATTEMPTS:
+        return "failed", None, error, None
+
+    delay = RETRY_BACKOFF[min(attempts, len(RETRY_BACKOFF)) - 1]
+    return "retrying", None, error, (datetime.now() + timedelta(seconds=delay)).isoformat()
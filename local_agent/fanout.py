@@ -0,0 +1,233 @@
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from bot_api import PRIMARY_BOT
+from bot_pool import not_member
+
+# Telegram Bot API limits (https://core.telegram.org/bots/faq#broadcasting-to-users),
+# each bot of the pool has its own
+GLOBAL_RATE = 30            # ~30 messages per second across all chats
+PRIVATE_CHAT_RATE = 1       # ~1 message per second to the same chat
+GROUP_CHAT_RATE = 20 / 60   # ~20 messages per minute to the same group
+
+DEFAULT_WORKERS = 16
+
+# Priority lanes and their share of the global rate while all are busy:
+# urgent gets 8 sends for every 1 bulk send. An idle lane costs nothing.
+LANE_WEIGHTS = {
+    "urgent": 8,
+    "normal": 4,
+    "deletes": 4,
+    "bulk": 1,
+}
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        # Waiters queue on the lock, so tokens are handed out in FIFO order
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class LaneScheduler:
+    """Hands out the global send budget across priority lanes.
+
+    Lanes with waiters are served by stride scheduling: each grant moves
+    the lane's pass on by 1 / weight and the lowest pass goes next. Inside
+    a lane, flows (one per broadcast) take turns, so a 20-chat alert is not
+    queued behind a 10,000-chat newsletter in the same lane.
+    """
+
+    def __init__(self, rate, weights=LANE_WEIGHTS):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.weights = weights
+        self.flows = {lane: {} for lane in weights}   # lane -> {flow: deque of futures}
+        self.passes = {lane: 0.0 for lane in weights}
+        self.now = 0.0                                # pass of the last grant
+        self.pending = asyncio.Event()
+        self.dispatcher = None
+
+    async def acquire(self, lane, flow):
+        if not self.flows[lane]:
+            # A lane back from idle doesn't get credit for the time it was idle
+            self.passes[lane] = max(self.passes[lane], self.now)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.flows[lane].setdefault(flow, deque()).append(waiter)
+        self.pending.set()
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self.dispatch())
+        await waiter
+
+    def next_lane(self):
+        busy = [lane for lane, flows in self.flows.items() if flows]
+        return min(busy, key=self.passes.get) if busy else None
+
+    def grant(self, lane):
+        """Wake the next waiter of the lane's next flow. False if all were cancelled."""
+        flows = self.flows[lane]
+        while flows:
+            flow = next(iter(flows))
+            waiters = flows.pop(flow)
+            waiter = waiters.popleft()
+            if waiters:
+                flows[flow] = waiters   # back of the round robin
+            if not waiter.done():
+                waiter.set_result(None)
+                self.now = self.passes[lane]
+                self.passes[lane] += 1 / self.weights[lane]
+                return True
+        return False
+
+    async def dispatch(self):
+        while True:
+            if self.next_lane() is None:
+                self.pending.clear()
+                await self.pending.wait()
+                continue
+
+            if self.bucket:
+                await self.bucket.acquire()
+            # Picked after the token wait, so an urgent send arriving
+            # meanwhile goes first
+            while True:
+                lane = self.next_lane()
+                if lane is None or self.grant(lane):
+                    break
+
+
+class FanoutEngine:
+    """Sends one payload to many chats with a bounded pool of workers.
+
+    The blocking Bot API calls run on a dedicated thread pool so the event
+    loop stays free, and every send first takes a token from the chat's
+    bucket and then from its bot's global budget, shared by all runs in
+    progress according to their lane. Each bot of the pool has its own
+    buckets and budget.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, global_rate=GLOBAL_RATE):
+        self.workers = workers
+        self.global_rate = global_rate
+        self.schedulers = {}    # bot_id -> LaneScheduler
+        self.chat_buckets = {}  # (bot_id, chat_id) -> TokenBucket
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fanout")
+
+    def set_global_rate(self, rate):
+        """Change every bot's global budget, e.g. to this worker's share of it."""
+        self.global_rate = rate
+        for scheduler in self.schedulers.values():
+            if isinstance(scheduler.bucket, TokenBucket):
+                scheduler.bucket.rate = rate
+
+    def set_pacer(self, key, pacer):
+        """Pace key's sends with pacer.acquire() instead of a token bucket, e.g. the userbot's governor."""
+        self.scheduler(key).bucket = pacer
+
+    def scheduler(self, bot_id):
+        scheduler = self.schedulers.get(bot_id)
+        if scheduler is None:
+            scheduler = self.schedulers[bot_id] = LaneScheduler(self.global_rate)
+        return scheduler
+
+    def chat_bucket(self, bot_id, chat_id):
+        bucket = self.chat_buckets.get((bot_id, chat_id))
+        if bucket is None:
+            # Negative ids are groups / channels, positive ids are private chats
+            rate = GROUP_CHAT_RATE if int(chat_id) < 0 else PRIVATE_CHAT_RATE
+            bucket = self.chat_buckets[(bot_id, chat_id)] = TokenBucket(rate)
+        return bucket
+
+    async def send(self, chat_id, send_one, lane="normal", flow=None, bot_id=None):
+        """Rate-limited send_one(chat_id) on the worker pool, within bot_id's limits.
+
+        Without a bot_id the primary bot's limits apply.
+        """
+        bot_id = bot_id or PRIMARY_BOT
+        await self.chat_bucket(bot_id, chat_id).acquire()
+        await self.scheduler(bot_id).acquire(lane, flow)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, send_one, chat_id)
+
+    async def send_routed(self, chat_id, send_one, bots, lane="normal", flow=None):
+        """send_one(chat_id, bot_id) through the first of bots that is a member of the chat.
+
+        The bot used is returned in the response as "bot_id".
+        """
+        for bot_id in bots:
+            response = await self.send(chat_id, lambda cid: send_one(cid, bot_id), lane, flow, bot_id)
+            if not not_member(response):
+                break
+        if response is not None:
+            response["bot_id"] = bot_id
+        return response
+
+    async def run(self, recipients, send_one, on_result=None, lane="normal", routes=None):
+        """Call send_one(chat_id) for every recipient, in the given priority lane.
+
+        With routes ({chat_id: [bot_id, ...]}, see bot_pool.plan_routes)
+        send_one(chat_id, bot_id) is called instead, through each chat's
+        bots in turn until one is a member there.
+
+        on_result(chat_id, response) is called on the event loop as soon as
+        each send completes. Returns a stats dict with sent / failed counts,
+        elapsed seconds and the achieved send rate.
+        """
+        pending = iter(recipients)
+        stats = {"sent": 0, "failed": 0}
+        flow = object()  # this run's turn in the lane's round robin
+
+        async def worker():
+            for chat_id in pending:
+                try:
+                    if routes:
+                        response = await self.send_routed(chat_id, send_one, routes[chat_id], lane, flow)
+                    else:
+                        response = await self.send(chat_id, send_one, lane, flow)
+                except Exception as e:
+                    print(f"Send to {chat_id} failed: {e}")
+                    response = None
+
+                if response and response.get("ok"):
+                    stats["sent"] += 1
+                else:
+                    stats["failed"] += 1
+
+                if on_result:
+                    try:
+                        on_result(chat_id, response)
+                    except Exception as e:
+                        print(f"Result handler failed for {chat_id}: {e}")
+
+        start = time.monotonic()
+        await asyncio.gather(*(worker() for _ in range(self.workers)))
+        elapsed = time.monotonic() - start
+
+        total = stats["sent"] + stats["failed"]
+        stats["elapsed"] = elapsed
+        stats["rate"] = total / elapsed if elapsed > 0 else 0.0
+        print(
+            f"Fan-out: {stats['sent']} sent, {stats['failed']} failed "
+            f"in {elapsed:.2f}s ({stats['rate']:.1f} msg/s)"
+        )
+        return stats
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
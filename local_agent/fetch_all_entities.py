@@ -1,50 +1,99 @@
 import asyncio
 import json
-from telethon import TelegramClient
-from telethon.sessions import StringSession
+import sys
+from datetime import datetime
+from db import connect, init_db, get_state, set_state
+from peer_cache import save_dialogs, entity_type, load_input_peers
+from telegram_client import get_client, login_and_save
 
-API_ID = 35246931
-API_HASH = "c14ab433b85e2250ec4ce4691a881443"
+# Dialogs written (and resume point recorded) per transaction
+BATCH_SIZE = 200
 
-OUTPUT_FILE = "telegram_entities.json"
+def flush(conn, batch, resume):
+    """Write a batch of dialogs together with the point to resume after it."""
+    save_dialogs(conn, batch)
+    set_state(conn, "entities_resume", json.dumps(resume))
+    conn.commit()
 
-async def main():
-    client = TelegramClient(StringSession(), API_ID, API_HASH)
-    await client.start()
+async def main(full=False):
+    """Stream dialogs into the entities table.
 
-    entities = []
+    Dialogs come newest-activity first, so a run stops at the first
+    (unpinned) dialog not touched since the last completed sync: the high
+    water mark. An interrupted run records where it got to and carries on
+    from there next time. Pass --full to walk every dialog regardless.
+    """
+    conn = connect()
+    init_db(conn)
 
-    print("\nFetching all Telegram groups, channels, and contacts...\n")
+    # Reuses session.txt, so no new login unless the session expired
+    client = get_client()
+    await login_and_save(client)
 
-    async for dialog in client.iter_dialogs():
-        entity = dialog.entity
+    resume = get_state(conn, "entities_resume")
+    resume = json.loads(resume) if resume else None
 
-        entity_type = (
-            "group" if dialog.is_group else
-            "channel" if dialog.is_channel else
-            "contact"
-        )
+    kwargs = {}
+    if resume:
+        stop_at = resume["stop_at"]
+        new_high_water = resume["high_water"]
+        peer = load_input_peers(conn, [resume["peer_id"]]).get(resume["peer_id"])
+        kwargs = {
+            "offset_date": datetime.fromisoformat(resume["date"]),
+            "offset_id": resume["msg_id"],
+            "offset_peer": peer,
+            "ignore_pinned": True
+        }
+        print(f"\nResuming interrupted sync from {resume['date']}...\n")
+    else:
+        stop_at = None if full else get_state(conn, "entities_high_water")
+        new_high_water = None
+        print("\nFetching changed Telegram groups, channels, and contacts...\n")
+
+    batch = []
+    count = 0
+
+    async for dialog in client.iter_dialogs(**kwargs):
+        date = dialog.date.isoformat() if dialog.date else None
 
-        username = getattr(entity, "username", None)
+        # Pinned dialogs are listed first whatever their date
+        if stop_at and date and not dialog.pinned and date <= stop_at:
+            print("Reached dialogs unchanged since the last sync.")
+            break
+
+        if date and (new_high_water is None or date > new_high_water):
+            new_high_water = date
 
         print(
             f"NAME: {dialog.name} | "
             f"ID: {dialog.id} | "
-            f"TYPE: {entity_type}"
+            f"TYPE: {entity_type(dialog)}"
         )
 
-        entities.append({
-            "name": dialog.name,
-            "id": dialog.id,
-            "username": username,
-            "type": entity_type
-        })
+        batch.append(dialog)
+        count += 1
+
+        if len(batch) >= BATCH_SIZE and date:
+            flush(conn, batch, {
+                "date": date,
+                "msg_id": dialog.message.id if dialog.message else 0,
+                "peer_id": dialog.id,
+                "stop_at": stop_at,
+                "high_water": new_high_water
+            })
+            batch = []
 
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        json.dump(entities, f, indent=2)
+    # Completed: drop the resume point and move the high water mark
+    save_dialogs(conn, batch)
+    set_state(conn, "entities_resume", None)
+    if new_high_water:
+        set_state(conn, "entities_high_water", new_high_water)
+    conn.commit()
 
-    print(f"\nSaved {len(entities)} entities to {OUTPUT_FILE}\n")
+    print(f"\nSaved {count} entities to storage.db\n")
 
     await client.disconnect()
+    conn.close()
 
-asyncio.run(main())
+if __name__ == "__main__":
+    asyncio.run(main(full="--full" in sys.argv))
@@ -0,0 +1,96 @@
+from db import placeholders
+
+
+def entity_label(name, entity_type):
+    return f"{name} ({entity_type})"
+
+
+def has_fts(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'entities_fts'"
+    ).fetchone() is not None
+
+
+def fts_query(text):
+    # Every word must match as a prefix: "dea 3" -> "dea"* "3"*
+    words = text.replace('"', " ").split()
+    return " ".join(f'"{w}"*' for w in words)
+
+
+def search_entities(conn, text, limit, offset=0):
+    """One page of (id, name, type) matching text, by relevance or by name."""
+    text = text.strip()
+    # Only quotes (or nothing) leave no words, and an empty MATCH is an error
+    query = fts_query(text)
+    if query and has_fts(conn):
+        return conn.execute("""
+            SELECT e.id, e.name, e.type
+            FROM entities_fts f JOIN entities e ON e.id = f.rowid
+            WHERE entities_fts MATCH ?
+            ORDER BY f.rank
+            LIMIT ? OFFSET ?
+        """, (query, limit, offset)).fetchall()
+
+    # No search words (or no FTS5): walk the name index. % and _ in the
+    # text are matched literally.
+    prefix = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return conn.execute("""
+        SELECT id, name, type FROM entities
+        WHERE name IS NOT NULL AND name LIKE ? || '%' ESCAPE '\\'
+        ORDER BY name COLLATE NOCASE
+        LIMIT ? OFFSET ?
+    """, (prefix, limit, offset)).fetchall()
+
+
+def folder_counts(conn):
+    """{folder: member count} for every folder, in one query."""
+    return dict(conn.execute("""
+        SELECT f.name, COUNT(fe.entity_id)
+        FROM folders f LEFT JOIN folder_entities fe ON fe.folder = f.name
+        GROUP BY f.name
+        ORDER BY f.name
+    """).fetchall())
+
+
+def folder_members(conn, folder, limit, offset=0):
+    return conn.execute("""
+        SELECT entity_id, label FROM folder_entities
+        WHERE folder = ?
+        ORDER BY label COLLATE NOCASE
+        LIMIT ? OFFSET ?
+    """, (folder, limit, offset)).fetchall()
+
+
+def add_members(conn, folder, entities):
+    """Upsert (entity_id, label) pairs into a folder."""
+    conn.executemany("""
+        INSERT INTO folder_entities (folder, entity_id, label) VALUES (?, ?, ?)
+        ON CONFLICT (folder, entity_id) DO UPDATE SET label = excluded.label
+    """, [(folder, eid, label) for eid, label in entities])
+    conn.commit()
+
+
+def remove_members(conn, folder, entity_ids):
+    conn.executemany(
+        "DELETE FROM folder_entities WHERE folder = ? AND entity_id = ?",
+        [(folder, eid) for eid in entity_ids]
+    )
+    conn.commit()
+
+
+def delete_folder(conn, folder):
+    conn.execute("DELETE FROM folder_entities WHERE folder = ?", (folder,))
+    conn.execute("DELETE FROM folders WHERE name = ?", (folder,))
+    conn.commit()
+
+
+def resolve_recipients(conn, include, exclude=()):
+    """Distinct entity ids in any include folder and in no exclude folder."""
+    if not include:
+        return []
+    params = list(include)
+    sql = f"SELECT DISTINCT entity_id FROM folder_entities WHERE folder IN ({placeholders(include)})"
+    if exclude:
+        params += list(exclude)
+        sql += f" EXCEPT SELECT entity_id FROM folder_entities WHERE folder IN ({placeholders(exclude)})"
+    return [r[0] for r in conn.execute(sql, params)]
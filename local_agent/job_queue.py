@@ -0,0 +1,121 @@
+import json
+import uuid
+from datetime import datetime
+
+from db import placeholders
+from wakeup import notify
+from workers import lease_until
+
+# Job lifecycle: pending -> running -> done / failed, or pending -> cancelled.
+# A running job is leased to one worker process until its lease runs out.
+
+# Due jobs are claimed most urgent first
+PRIORITY_ORDER = "CASE priority WHEN 'urgent' THEN 0 WHEN 'bulk' THEN 2 ELSE 1 END"
+
+# Send backends a job can ask for; a worker only claims the ones it can drive
+BACKENDS = ["bot", "userbot"]
+
+
+def enqueue(conn, task, job_id=None):
+    """Add a task dict to the queue. Tasks without send_at run immediately."""
+    job_id = job_id or str(uuid.uuid4())
+    now = datetime.now().isoformat()
+    conn.execute("""
+        INSERT INTO jobs (id, type, payload, send_at, priority, backend, status, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, 'pending', ?, ?)
+    """, (
+        job_id, task["type"], json.dumps(task), task.get("send_at") or now,
+        task.get("priority", "normal"), task.get("backend", "bot"), now, now
+    ))
+    conn.commit()
+    notify()
+    return job_id
+
+
+def enqueue_many(conn, tasks):
+    now = datetime.now().isoformat()
+    conn.executemany("""
+        INSERT INTO jobs (id, type, payload, send_at, priority, backend, status, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, 'pending', ?, ?)
+    """, [
+        (
+            str(uuid.uuid4()), t["type"], json.dumps(t), t.get("send_at") or now,
+            t.get("priority", "normal"), t.get("backend", "bot"), now, now
+        )
+        for t in tasks
+    ])
+    conn.commit()
+    notify()
+
+
+def claim_due(conn, worker_id, limit=50, backends=BACKENDS):
+    """Atomically lease due jobs for the given backends to a worker and return them as (id, task) pairs.
+
+    Jobs whose lease has run out (their worker died) are claimed again.
+    Served by the (status, send_at) index, so future-dated jobs are never read.
+    """
+    now = datetime.now().isoformat()
+    rows = conn.execute(f"""
+        UPDATE jobs SET status = 'running', worker_id = ?, lease_until = ?, updated_at = ?
+        WHERE id IN (
+            SELECT id FROM jobs
+            WHERE ((status = 'pending' AND send_at <= ?)
+                OR (status = 'running' AND lease_until < ?))
+              AND backend IN ({placeholders(backends)})
+            ORDER BY {PRIORITY_ORDER}, send_at
+            LIMIT ?
+        )
+        RETURNING id, payload, send_at, {PRIORITY_ORDER}
+    """, (worker_id, lease_until(), now, now, now, *backends, limit)).fetchall()
+    conn.commit()
+
+    # RETURNING doesn't preserve the subquery order
+    rows.sort(key=lambda r: (r[3], r[2]))
+    return [(job_id, json.loads(payload)) for job_id, payload, _, _ in rows]
+
+
+def next_send_at(conn, backends=BACKENDS):
+    """When the earliest pending job for the backends is due, or None if there is none."""
+    row = conn.execute(
+        f"SELECT MIN(send_at) FROM jobs WHERE status = 'pending' AND backend IN ({placeholders(backends)})",
+        backends
+    ).fetchone()
+    return datetime.fromisoformat(row[0]) if row[0] else None
+
+
+# complete / reschedule / fail only apply while the worker still holds the
+# job, so a worker that lost its lease can't overwrite the new owner's state
+
+def complete(conn, job_id, worker_id):
+    conn.execute(
+        "UPDATE jobs SET status = 'done', updated_at = ? WHERE id = ? AND worker_id = ?",
+        (datetime.now().isoformat(), job_id, worker_id)
+    )
+    conn.commit()
+
+
+def reschedule(conn, job_id, worker_id, send_at):
+    """Put a claimed job back in the queue to run again at send_at."""
+    conn.execute(
+        "UPDATE jobs SET status = 'pending', send_at = ?, updated_at = ? WHERE id = ? AND worker_id = ?",
+        (send_at.isoformat(), datetime.now().isoformat(), job_id, worker_id)
+    )
+    conn.commit()
+
+
+def fail(conn, job_id, worker_id, error):
+    conn.execute(
+        "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ? AND worker_id = ?",
+        (str(error), datetime.now().isoformat(), job_id, worker_id)
+    )
+    conn.commit()
+
+
+def cancel(conn, job_id):
+    """Cancel a job that hasn't started yet. Returns False if it already ran."""
+    cur = conn.execute(
+        "UPDATE jobs SET status = 'cancelled', updated_at = ? WHERE id = ? AND status = 'pending'",
+        (datetime.now().isoformat(), job_id)
+    )
+    conn.commit()
+    return cur.rowcount > 0
@@ -0,0 +1,56 @@
+import hashlib
+from datetime import datetime
+
+from db import connect
+
+# Response field holding the uploaded file for each send method
+RESULT_FIELDS = {
+    "photo": "photo",
+    "document": "document",
+}
+
+
+def file_hash(file_path):
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def extract_file_id(response, file_type):
+    """Pull the Telegram file_id out of a sendPhoto / sendDocument response."""
+    if not response or not response.get("ok"):
+        return None
+
+    media = response["result"].get(RESULT_FIELDS.get(file_type, file_type))
+    if not media:
+        return None
+    if isinstance(media, list):
+        # Photos come back in several sizes, the last one is the original
+        media = media[-1]
+    return media.get("file_id")
+
+
+def get_file_id(fhash, file_type, bot_id):
+    conn = connect()
+    try:
+        row = conn.execute(
+            "SELECT file_id FROM media_cache WHERE file_hash = ? AND file_type = ? AND bot_id = ?",
+            (fhash, file_type, bot_id)
+        ).fetchone()
+        return row[0] if row else None
+    finally:
+        conn.close()
+
+
+def save_file_id(fhash, file_type, bot_id, file_id):
+    conn = connect()
+    try:
+        conn.execute("""
+            INSERT OR REPLACE INTO media_cache (file_hash, file_type, bot_id, file_id, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (fhash, file_type, bot_id, file_id, datetime.now().isoformat()))
+        conn.commit()
+    finally:
+        conn.close()
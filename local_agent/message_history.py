@@ -0,0 +1,74 @@
+import csv
+import io
+from datetime import datetime
+
+COLUMNS = ["id", "task_id", "task_name", "task_type", "folders", "recipients", "has_media", "created_at"]
+
+
+def log_task(conn, task_id, task_name, task_type, folders, recipients, has_media):
+    """Record a queued broadcast in message_logs. The caller commits."""
+    cur = conn.execute("""
+        INSERT INTO message_logs
+        (task_id, task_name, task_type, folders, recipients, has_media, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (
+        task_id,
+        task_name if task_name else "Untitled",
+        task_type,
+        ",".join(folders),
+        recipients,
+        1 if has_media else 0,
+        datetime.now().isoformat()
+    ))
+    conn.executemany(
+        "INSERT OR IGNORE INTO message_log_folders (folder, log_id) VALUES (?, ?)",
+        [(folder, cur.lastrowid) for folder in folders]
+    )
+
+
+def filtered_query(task_type=None, folder=None):
+    """SELECT over message_logs with the filters as indexed WHERE clauses."""
+    sql = f"SELECT {', '.join('ml.' + c for c in COLUMNS)} FROM message_logs ml"
+    where, params = [], []
+    if folder:
+        sql += " JOIN message_log_folders mf ON mf.log_id = ml.id AND mf.folder = ?"
+        params.append(folder)
+    if task_type:
+        where.append("ml.task_type = ?")
+        params.append(task_type)
+    return sql, where, params
+
+
+def history_page(conn, limit, task_type=None, folder=None, before=None):
+    """Up to limit logs, newest first, older than the (created_at, id) key before.
+
+    Keyset pagination: every page is an index range scan, however deep.
+    """
+    sql, where, params = filtered_query(task_type, folder)
+    if before:
+        where.append("(ml.created_at, ml.id) < (?, ?)")
+        params += list(before)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY ml.created_at DESC, ml.id DESC LIMIT ?"
+    params.append(limit)
+    return conn.execute(sql, params).fetchall()
+
+
+def iter_csv(conn, task_type=None, folder=None, chunk=1000):
+    """Yield the filtered history as CSV text, chunk rows at a time."""
+    sql, where, params = filtered_query(task_type, folder)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY ml.created_at DESC, ml.id DESC"
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    cur = conn.execute(sql, params)
+    rows = [COLUMNS]
+    while rows:
+        writer.writerows(rows)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        rows = cur.fetchmany(chunk)
@@ -0,0 +1,200 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from bot_api import BOTS
+from db import connect, placeholders
+
+
+class MessageStore:
+    """Writer for sent_messages, deliveries and chat_bots on one persistent WAL connection.
+
+    Each send's delivery outcome is committed as the send completes,
+    together with the sent_messages row of a delivered message, so a
+    restarted job never messages a recipient whose send was already
+    answered, and no sent delivery lacks the row the expiry sweeper and
+    Undo work from. That is one commit (WAL, synchronous=FULL) per send.
+    Status updates are buffered and written with executemany in a single
+    transaction once BATCH_SIZE rows are waiting or FLUSH_INTERVAL seconds
+    have passed. Rows whose commit fails (e.g. database is locked) stay
+    buffered for the next flush.
+    """
+
+    BATCH_SIZE = 200
+    FLUSH_INTERVAL = 0.5
+    # Pause between attempts of sync() while the database refuses writes
+    RETRY_SECONDS = 2
+
+    UPDATE_DELIVERY = """
+        UPDATE deliveries
+        SET status = ?, attempts = attempts + 1, message_id = ?, error = ?,
+            next_attempt_at = ?, updated_at = ?
+        WHERE job_id = ? AND chat_id = ?
+    """
+    INSERT_SENT = """
+        INSERT INTO sent_messages (task_id, chat_id, message_id, sent_at, status, expires_at, poll_id, bot_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """
+    UPSERT_CHAT_BOT = """
+        INSERT INTO chat_bots (chat_id, bot_id, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT (chat_id) DO UPDATE SET bot_id = excluded.bot_id, updated_at = excluded.updated_at
+    """
+
+    def __init__(self):
+        self.conn = connect()
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.inserts = []
+        self.status_updates = []
+        self.delivery_updates = []
+        self.chat_bots = {}
+        self.last_flush = time.monotonic()
+
+    def set_status(self, chat_id, message_id, status, bot_id=None):
+        # Two pool bots can each have a message with the same id in a user's chat
+        self.status_updates.append((status, chat_id, message_id, bot_id))
+        self._maybe_flush()
+
+    def set_delivery(self, job_id, chat_id, status, message_id=None, error=None, next_attempt_at=None, sent=None):
+        """Commit one send's delivery state.
+
+        For a delivered message, sent holds its sent_messages fields
+        (message_id, and optionally expires_at, poll_id, bot_id). The row
+        and the chat's pool bot are written in the same transaction.
+        """
+        now = datetime.now().isoformat()
+        row = (status, message_id, error, next_attempt_at, now, job_id, chat_id)
+        insert = chat_bot = None
+        if sent:
+            expires_at = sent.get("expires_at")
+            bot_id = sent.get("bot_id")
+            insert = (
+                job_id, chat_id, sent["message_id"], now, "sent",
+                expires_at.isoformat() if expires_at else None, sent.get("poll_id"), bot_id
+            )
+            # The chat sticks to the pool bot that reached it
+            if bot_id in BOTS:
+                chat_bot = (chat_id, bot_id, now)
+
+        if not self.delivery_updates:
+            try:
+                with self.conn:
+                    self.conn.execute(self.UPDATE_DELIVERY, row)
+                    if insert:
+                        self.conn.execute(self.INSERT_SENT, insert)
+                    if chat_bot:
+                        self.conn.execute(self.UPSERT_CHAT_BOT, chat_bot)
+                return
+            except Exception as e:
+                print(f"DB Error, delivery of {chat_id} kept for the next flush: {e}")
+
+        # Behind earlier deliveries still waiting, and written with them
+        self.delivery_updates.append(row)
+        if insert:
+            self.inserts.append(insert)
+        if chat_bot:
+            self.chat_bots[chat_id] = chat_bot
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        pending = len(self.inserts) + len(self.status_updates) + len(self.delivery_updates)
+        if pending >= self.BATCH_SIZE or time.monotonic() - self.last_flush >= self.FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Write everything buffered in one transaction. False if it failed; the rows are kept."""
+        self.last_flush = time.monotonic()
+        if not self.inserts and not self.status_updates and not self.delivery_updates:
+            return True
+
+        inserts, self.inserts = self.inserts, []
+        updates, self.status_updates = self.status_updates, []
+        deliveries, self.delivery_updates = self.delivery_updates, []
+        chat_bots, self.chat_bots = self.chat_bots, {}
+        try:
+            with self.conn:
+                # Sends whose own commit failed
+                self.conn.executemany(self.INSERT_SENT, inserts)
+                self.conn.executemany(self.UPSERT_CHAT_BOT, chat_bots.values())
+                self.conn.executemany("""
+                    UPDATE sent_messages SET status = ? WHERE chat_id = ? AND message_id = ? AND bot_id IS ?
+                """, updates)
+                self.conn.executemany(self.UPDATE_DELIVERY, deliveries)
+        except Exception as e:
+            print(f"DB Error, {len(inserts) + len(updates) + len(deliveries)} rows kept for the next flush: {e}")
+            # Ahead of anything buffered meanwhile, so updates still follow their inserts
+            self.inserts = inserts + self.inserts
+            self.status_updates = updates + self.status_updates
+            self.delivery_updates = deliveries + self.delivery_updates
+            chat_bots.update(self.chat_bots)
+            self.chat_bots = chat_bots
+            return False
+        return True
+
+    async def sync(self):
+        """Flush until it succeeds, before anything is decided from the database state."""
+        while not self.flush():
+            await asyncio.sleep(self.RETRY_SECONDS)
+
+    def senders(self, pool):
+        """WHERE clause and params picking the pool bots' messages, or with pool=False everyone else's."""
+        bots = list(BOTS)
+        if pool:
+            # NULL is the primary bot, from before the pool
+            return f"(bot_id IS NULL OR bot_id IN ({placeholders(bots)}))", bots
+        return f"bot_id NOT IN ({placeholders(bots)})", bots
+
+    def due_expiries(self, pool=True):
+        """Expired messages still live in Telegram, grouped as {bot_id: {chat_id: [message_id, ...]}}.
+
+        Only the account that sent a message can delete it. With pool=True
+        these are the pool bots' messages (bot_id None for ones sent before
+        the pool, by the primary bot), otherwise the userbot's and those of
+        senders no longer configured.
+        """
+        where, params = self.senders(pool)
+        # Without ANALYZE the planner prefers (status, sent_at), which walks
+        # every live message; the partial index holds only the temporary ones
+        rows = self.conn.execute(f"""
+            SELECT bot_id, chat_id, message_id FROM sent_messages INDEXED BY idx_sent_messages_expiry
+            WHERE status = 'sent' AND expires_at <= ? AND {where}
+        """, [datetime.now().isoformat()] + params).fetchall()
+
+        due = {}
+        for bot_id, chat_id, message_id in rows:
+            due.setdefault(bot_id, {}).setdefault(chat_id, []).append(message_id)
+        return due
+
+    def sender(self, chat_id, message_id):
+        """The bot that sent a message, None for the primary bot."""
+        row = self.conn.execute(
+            "SELECT bot_id FROM sent_messages WHERE chat_id = ? AND message_id = ?", (chat_id, message_id)
+        ).fetchone()
+        return row[0] if row else None
+
+    def next_expiry(self, pool=True):
+        # Runs on every daemon pass; see due_expiries for the index
+        where, params = self.senders(pool)
+        row = self.conn.execute(f"""
+            SELECT MIN(expires_at) FROM sent_messages INDEXED BY idx_sent_messages_expiry
+            WHERE status = 'sent' AND expires_at IS NOT NULL AND {where}
+        """, params).fetchone()
+        return datetime.fromisoformat(row[0]) if row[0] else None
+
+    def postpone_expiry(self, chat_id, message_ids, seconds, bot_id=None):
+        """Retry a failed deletion later instead of on every sweep."""
+        retry_at = (datetime.now() + timedelta(seconds=seconds)).isoformat()
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE sent_messages SET expires_at = ? WHERE chat_id = ? AND message_id = ? AND bot_id IS ?",
+                [(retry_at, chat_id, mid, bot_id) for mid in message_ids]
+            )
+
+    async def run_flusher(self):
+        """Flush partially filled batches in the background."""
+        while True:
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+            self.flush()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
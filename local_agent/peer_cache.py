@@ -0,0 +1,139 @@
+import json
+from datetime import datetime
+
+from telethon import utils
+from telethon.tl.types import (
+    Channel, Chat, User,
+    InputPeerChannel, InputPeerChat, InputPeerUser,
+)
+
+from db import placeholders, set_state
+
+# SQLite's default limit on bound parameters is 999
+QUERY_CHUNK = 500
+
+
+def peer_row(entity):
+    """(marked id, access_hash, peer_type) for a Telethon User / Chat / Channel."""
+    if isinstance(entity, User):
+        peer_type = "user"
+    elif isinstance(entity, Chat):
+        peer_type = "chat"
+    elif isinstance(entity, Channel):
+        peer_type = "channel"
+    else:
+        return None
+    return utils.get_peer_id(entity), getattr(entity, "access_hash", None), peer_type
+
+
+def save_peers(conn, entities):
+    now = datetime.now().isoformat()
+    rows = [row + (now,) for row in map(peer_row, entities) if row]
+    conn.executemany("""
+        INSERT INTO entities (id, access_hash, peer_type, updated_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET
+            access_hash = COALESCE(excluded.access_hash, entities.access_hash),
+            peer_type = excluded.peer_type,
+            updated_at = excluded.updated_at
+    """, rows)
+    conn.commit()
+    return len(rows)
+
+
+def entity_type(dialog):
+    return (
+        "group" if dialog.is_group else
+        "channel" if dialog.is_channel else
+        "contact"
+    )
+
+
+def save_dialogs(conn, dialogs):
+    """Upsert name, username, type and peer data for Telethon dialogs. The caller commits."""
+    now = datetime.now().isoformat()
+    rows = []
+    for dialog in dialogs:
+        _, access_hash, peer_type = peer_row(dialog.entity) or (None, None, None)
+        rows.append((
+            dialog.id, access_hash, peer_type, dialog.name,
+            getattr(dialog.entity, "username", None), entity_type(dialog), now
+        ))
+
+    conn.executemany("""
+        INSERT INTO entities (id, access_hash, peer_type, name, username, type, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET
+            access_hash = COALESCE(excluded.access_hash, entities.access_hash),
+            peer_type = COALESCE(excluded.peer_type, entities.peer_type),
+            name = excluded.name,
+            username = excluded.username,
+            type = excluded.type,
+            updated_at = excluded.updated_at
+    """, rows)
+    # Lets the Streamlit app know its cached entity list is stale
+    set_state(conn, "entities_version", now)
+
+
+def import_entities_json(conn, path):
+    """Seed the table from a telegram_entities.json export."""
+    with open(path, "r", encoding="utf-8") as f:
+        entities = json.load(f)
+
+    now = datetime.now().isoformat()
+    conn.executemany("""
+        INSERT INTO entities (id, name, username, type, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET
+            name = excluded.name,
+            username = excluded.username,
+            type = excluded.type
+    """, [(e["id"], e["name"], e.get("username"), e["type"], now) for e in entities])
+    set_state(conn, "entities_version", now)
+    conn.commit()
+    return len(entities)
+
+
+def load_input_peers(conn, chat_ids):
+    """{chat_id: InputPeer} for every chat id the cache can resolve."""
+    chat_ids = list(chat_ids)
+    peers = {}
+    for i in range(0, len(chat_ids), QUERY_CHUNK):
+        chunk = chat_ids[i:i + QUERY_CHUNK]
+        rows = conn.execute(f"""
+            SELECT id, access_hash, peer_type FROM entities
+            WHERE id IN ({placeholders(chunk)})
+        """, chunk).fetchall()
+
+        for chat_id, access_hash, peer_type in rows:
+            real_id = utils.resolve_id(chat_id)[0]
+            if peer_type == "chat":
+                peers[chat_id] = InputPeerChat(real_id)
+            elif access_hash is None:
+                continue
+            elif peer_type == "channel":
+                peers[chat_id] = InputPeerChannel(real_id, access_hash)
+            elif peer_type == "user":
+                peers[chat_id] = InputPeerUser(real_id, access_hash)
+    return peers
+
+
+async def resolve_missing(client, conn, chat_ids):
+    """Walk the dialog list until every chat id is cached, saving as we go.
+
+    Only needed for chats the cache has never seen; stops as soon as the
+    last missing one turns up. Returns the ids that were never found.
+    """
+    missing = set(chat_ids)
+    batch = []
+    async for dialog in client.iter_dialogs():
+        batch.append(dialog.entity)
+        missing.discard(dialog.id)
+        if len(batch) >= 100:
+            save_peers(conn, batch)
+            batch = []
+        if not missing:
+            break
+
+    save_peers(conn, batch)
+    return missing
@@ -0,0 +1,142 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from bot_api import call, PRIMARY_BOT
+from db import connect, get_state, set_state
+import workers
+
+# Long-poll getUpdates for this many seconds; Telegram answers as soon as
+# there is something, with up to 100 updates per call
+LONG_POLL_SECONDS = 25
+# Pause after a failed getUpdates before trying again
+ERROR_BACKOFF_SECONDS = 10
+
+# The userbot's quizzes are re-read this often, for this many days after sending
+USERBOT_REFRESH_SECONDS = 60
+USERBOT_POLL_DAYS = 7
+# Messages per get_messages call
+USERBOT_READ_CHUNK = 100
+
+
+def offset_key(bot_id):
+    # The primary bot keeps the key from before the bot pool
+    return "poll_updates_offset" if bot_id == PRIMARY_BOT else f"poll_updates_offset:{bot_id}"
+
+
+def fetch_poll_updates(offset, bot_id):
+    """One getUpdates call for bot_id's poll updates only. Returns (polls, next offset)."""
+    response = call(
+        "getUpdates",
+        {"offset": offset, "timeout": LONG_POLL_SECONDS, "allowed_updates": ["poll"]},
+        timeout=(5, LONG_POLL_SECONDS + 10),
+        bot_id=bot_id
+    )
+    if not response.get("ok"):
+        raise RuntimeError(response.get("description"))
+
+    polls = {}
+    for update in response["result"]:
+        offset = max(offset, update["update_id"] + 1)
+        if "poll" in update:
+            # Later updates of the same poll supersede earlier ones
+            polls[update["poll"]["id"]] = update["poll"]
+    return list(polls.values()), offset
+
+
+def save_votes(conn, counts):
+    """Upsert {poll_id: [votes per option]}. The caller commits."""
+    conn.executemany("""
+        INSERT INTO poll_votes (poll_id, option, votes) VALUES (?, ?, ?)
+        ON CONFLICT (poll_id, option) DO UPDATE SET votes = excluded.votes
+    """, [
+        (poll_id, i, votes)
+        for poll_id, options in counts.items()
+        for i, votes in enumerate(options)
+    ])
+
+
+def save_polls(conn, polls, offset, bot_id):
+    """Store the latest vote counts and the bot's update offset together."""
+    save_votes(conn, {
+        poll["id"]: [option.get("voter_count", 0) for option in poll["options"]]
+        for poll in polls
+    })
+    set_state(conn, offset_key(bot_id), str(offset))
+    conn.commit()
+
+
+async def run_collector(bot_id):
+    """Keep poll_votes current from bot_id's update stream.
+
+    Telegram pushes a poll update to the bot whenever a poll it sent gets a
+    vote, so one long-polling getUpdates loop per bot covers every
+    recipient chat. The offset is stored with the votes, so no update is
+    lost or applied twice across restarts. Telegram allows one getUpdates
+    consumer per bot, so only the worker holding the bot's poll_collector
+    lease polls.
+    """
+    conn = connect()
+    loop = asyncio.get_running_loop()
+
+    try:
+        while True:
+            try:
+                if not workers.acquire(conn, f"poll_collector:{bot_id}"):
+                    await asyncio.sleep(workers.HEARTBEAT_SECONDS)
+                    continue
+
+                # Re-read, another worker may have been collecting
+                offset = int(get_state(conn, offset_key(bot_id), 0))
+                polls, new_offset = await loop.run_in_executor(None, fetch_poll_updates, offset, bot_id)
+
+                if new_offset != offset:
+                    save_polls(conn, polls, new_offset, bot_id)
+                    if polls:
+                        print(f"Poll results: updated {len(polls)} polls")
+            except Exception as e:
+                # The offset only moves with the votes, so the updates are fetched again
+                print(f"Poll results: collector for bot {bot_id} failed: {e}")
+                conn.rollback()
+                await asyncio.sleep(ERROR_BACKOFF_SECONDS)
+    finally:
+        conn.close()
+
+
+def userbot_polls(conn, user_id):
+    """{chat_id: [message_id, ...]} of the quizzes the userbot sent in the last USERBOT_POLL_DAYS."""
+    since = (datetime.now() - timedelta(days=USERBOT_POLL_DAYS)).isoformat()
+    polls = {}
+    for chat_id, message_id in conn.execute("""
+        SELECT chat_id, message_id FROM sent_messages
+        WHERE status = 'sent' AND sent_at >= ? AND bot_id = ? AND poll_id IS NOT NULL
+    """, (since, user_id)):
+        polls.setdefault(chat_id, []).append(message_id)
+    return polls
+
+
+async def run_userbot_collector(userbot):
+    """Keep poll_votes current for the quizzes the userbot sent.
+
+    A user account has no getUpdates stream, so the worker driving it
+    re-reads its recent quizzes every USERBOT_REFRESH_SECONDS, one
+    get_messages call per chat and USERBOT_READ_CHUNK messages.
+    """
+    conn = connect()
+    try:
+        while True:
+            try:
+                user_id = userbot.account_id() if userbot.held else None
+                polls = userbot_polls(conn, user_id) if user_id else {}
+                if polls:
+                    await userbot.prepare(list(polls))
+                    for chat_id, ids in polls.items():
+                        for i in range(0, len(ids), USERBOT_READ_CHUNK):
+                            counts = await userbot.poll_results(chat_id, ids[i:i + USERBOT_READ_CHUNK])
+                            save_votes(conn, counts)
+                            conn.commit()
+            except Exception as e:
+                print(f"Poll results: userbot collector failed: {e}")
+                conn.rollback()
+            await asyncio.sleep(USERBOT_REFRESH_SECONDS)
+    finally:
+        conn.close()
@@ -1,33 +1,163 @@
 import json
-import subprocess
-from apscheduler.schedulers.background import BackgroundScheduler
-from datetime import datetime
+import sys
+import uuid
+from datetime import datetime, timedelta
 
-scheduler = BackgroundScheduler()
-scheduler.start()
+from apscheduler.triggers.cron import CronTrigger
+
+import folder_store
+import job_queue
+import message_history
+from db import connect, init_db
+from wakeup import notify
+
+# Recurring broadcasts live in the schedules table. The daemon calls
+# fire_due() from its main loop: every schedule whose next_run_at has come
+# is enqueued as an ordinary job and moved on to its next fire time, in one
+# transaction, so nothing is lost or sent twice across restarts. Nothing
+# is spawned; the jobs run in the daemon like any other.
+
+LOG_TYPES = {"message": "message", "poll": "quiz"}
+
+
+def next_fire(kind, spec, after):
+    """The first fire time of a cron / interval schedule after `after`."""
+    if kind == "interval":
+        return after + timedelta(seconds=float(spec))
+    # APScheduler only computes fire times here; nothing runs on its threads
+    fire = CronTrigger.from_crontab(spec).get_next_fire_time(None, after.astimezone())
+    return fire.astimezone().replace(tzinfo=None) if fire else None
+
+
+def advance(kind, spec, scheduled, now):
+    """The fire time after a run due at `scheduled`, skipping any missed ones."""
+    if kind == "interval":
+        # Stays on the original grid, so an hourly 09:00 schedule keeps firing on the hour
+        step = timedelta(seconds=float(spec))
+        return scheduled + step * ((now - scheduled) // step + 1)
+    return next_fire(kind, spec, now)
+
+
+def add_schedule(conn, task, cron=None, every_seconds=None, start_at=None, name=None):
+    """Store a recurring broadcast and return its id.
+
+    task is a job_queue task dict. With "folders" (and optionally
+    "exclude_folders") in it, recipients are resolved again on every run,
+    so folder changes apply to later runs. Give either a crontab
+    expression (cron="0 9 * * *" for 09:00 daily) or an interval in
+    seconds, first firing at start_at (default: one interval from now).
+    """
+    kind, spec = ("cron", cron) if cron else ("interval", str(every_seconds))
+    next_run = start_at or next_fire(kind, spec, datetime.now())
+
+    schedule_id = str(uuid.uuid4())
+    now = datetime.now().isoformat()
+    conn.execute("""
+        INSERT INTO schedules (id, name, task, kind, spec, next_run_at, enabled, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, 1, ?)
+    """, (schedule_id, name or task.get("task_name"), json.dumps(task), kind, spec, next_run.isoformat(), now))
+    conn.commit()
+    # The daemon sleeps until its next known deadline
+    notify()
+    return schedule_id
+
+
+def set_enabled(conn, schedule_id, enabled):
+    """Pause or resume a schedule. A resumed one fires next after now, not for the runs it missed."""
+    row = conn.execute("SELECT kind, spec FROM schedules WHERE id = ?", (schedule_id,)).fetchone()
+    if not row:
+        return
+    next_run = next_fire(row[0], row[1], datetime.now())
+    conn.execute(
+        "UPDATE schedules SET enabled = ?, next_run_at = ? WHERE id = ?",
+        (1 if enabled else 0, next_run.isoformat() if next_run else None, schedule_id)
+    )
+    conn.commit()
+    notify()
+
+
+def delete_schedule(conn, schedule_id):
+    conn.execute("DELETE FROM schedules WHERE id = ?", (schedule_id,))
+    conn.commit()
+
+
+def next_due_at(conn):
+    """When the next enabled schedule fires, or None."""
+    row = conn.execute("SELECT MIN(next_run_at) FROM schedules WHERE enabled = 1").fetchone()
+    return datetime.fromisoformat(row[0]) if row[0] else None
+
+
+def fire_due(conn):
+    """Enqueue a job for every schedule that is due. Returns the number enqueued.
+
+    Runs missed while no daemon was up are coalesced into one. Moving
+    next_run_at only if it is still the value read makes this safe with
+    several workers: each fire time is claimed by exactly one.
+    """
+    now = datetime.now()
+    due = conn.execute("""
+        SELECT id, name, task, kind, spec, next_run_at FROM schedules
+        WHERE enabled = 1 AND next_run_at <= ?
+    """, (now.isoformat(),)).fetchall()
+
+    fired = 0
+    for schedule_id, name, task_json, kind, spec, next_run_at in due:
+        next_run = advance(kind, spec, datetime.fromisoformat(next_run_at), now)
+        cur = conn.execute("""
+            UPDATE schedules SET next_run_at = ?, last_run_at = ?
+            WHERE id = ? AND next_run_at = ?
+        """, (next_run.isoformat() if next_run else None, now.isoformat(), schedule_id, next_run_at))
+        if cur.rowcount == 0:
+            conn.commit()
+            continue
+
+        task = json.loads(task_json)
+        if task.get("folders"):
+            task["recipients"] = folder_store.resolve_recipients(
+                conn, task["folders"], task.get("exclude_folders", ())
+            )
+        task["send_at"] = None
+        task["schedule_id"] = schedule_id
+
+        # The job and its history entry commit together with the advance
+        job_id = str(uuid.uuid4())
+        message_history.log_task(
+            conn, job_id, name, LOG_TYPES.get(task["type"], task["type"]),
+            task.get("folders", []), len(task.get("recipients", [])), task.get("file_path")
+        )
+        job_queue.enqueue(conn, task, job_id=job_id)
+        fired += 1
+        print(f"Schedule {name or schedule_id} fired, next run {next_run}")
+    return fired
 
 
 def schedule_task(task_file):
+    """Queue a task file for its send_at, as the old agent.py spool did.
+
+    Accepts the legacy {"recipients", "message", "send_at"} format, which
+    agent.py sent from the user account, so it still goes out as the userbot.
+    """
     with open(task_file, "r") as f:
         task = json.load(f)
 
-    send_at = task.get("send_at")
-    if not send_at:
-        print("No schedule found in task.")
-        return
-
-    run_time = datetime.fromisoformat(send_at)
+    if "type" not in task:
+        task = {
+            "type": "message",
+            "recipients": task.get("recipients", []),
+            "content": task.get("message", ""),
+            "send_at": task.get("send_at"),
+            "backend": "userbot",
+        }
 
-    scheduler.add_job(
-        subprocess.call,
-        trigger="date",
-        run_date=run_time,
-        args=(["python", "agent.py", task_file],)
-    )
+    conn = connect()
+    try:
+        init_db(conn)
+        job_id = job_queue.enqueue(conn, task)
+    finally:
+        conn.close()
 
-    print(f"Task scheduled at {run_time}")
+    print(f"Task {job_id} queued for {task.get('send_at') or 'now'}")
 
 
 if __name__ == "__main__":
-    schedule_task("task.json")
-    input("Scheduler running. Press Enter to exit...")
+    schedule_task(sys.argv[1] if len(sys.argv) > 1 else "task.json")
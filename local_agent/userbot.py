@@ -0,0 +1,221 @@
+import asyncio
+import time
+
+from telethon.errors import FloodWaitError, RPCError
+from telethon.tl.types import InputMediaPoll, MessageMediaPoll, Poll, PollAnswer, TextWithEntities
+
+from db import get_state, set_state
+from peer_cache import load_input_peers, resolve_missing
+from telegram_client import get_client
+
+# Fan-out engine key and lease name of the user account backend
+USERBOT = "userbot"
+
+# Telegram doesn't publish limits for user accounts, so sends start this
+# many seconds apart and the governor adapts to the flood waits it gets
+START_INTERVAL = 1.0
+MIN_INTERVAL = 0.3
+MAX_INTERVAL = 30.0
+# After this many clean sends the interval is eased by EASE_FACTOR
+EASE_AFTER = 20
+EASE_FACTOR = 0.9
+# A longer flood wait fails the send, which deliveries retries later
+MAX_FLOOD_WAIT = 60
+
+
+class SendGovernor:
+    """Paces userbot sends by what Telegram tolerates, shared by every job of the worker.
+
+    A FloodWaitError pauses all sends until it is over and doubles the
+    interval between sends; every EASE_AFTER clean sends shorten it by 10%
+    again. Serves as the userbot's global bucket in the fan-out engine, so
+    priority lanes still decide who sends next.
+    """
+
+    def __init__(self, interval=START_INTERVAL):
+        self.interval = interval
+        self.next_at = 0.0
+        self.resume_at = 0.0
+        self.clean = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            # A flood wait can move resume_at while we sleep
+            while True:
+                delay = max(self.next_at, self.resume_at) - time.monotonic()
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            self.next_at = time.monotonic() + self.interval
+
+    def flood_wait(self, seconds):
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+        self.interval = min(MAX_INTERVAL, self.interval * 2)
+        self.clean = 0
+
+    def succeeded(self):
+        self.clean += 1
+        if self.clean >= EASE_AFTER:
+            self.clean = 0
+            self.interval = max(MIN_INTERVAL, self.interval * EASE_FACTOR)
+
+
+class Userbot:
+    """Send backend for the telegram_client user account, on one persistent session.
+
+    The Telethon calls run on the daemon's event loop. send_text /
+    send_file / send_poll / delete_messages are blocking and reply like the
+    Bot API senders ({"ok": ..., "result": ...} or error_code and
+    description), so the fan-out engine's worker threads and the delivery
+    tracking treat both backends alike.
+    """
+
+    def __init__(self, conn, loop):
+        self.conn = conn
+        self.loop = loop
+        self.client = None
+        self.user_id = None
+        self.held = False   # whether this worker holds the userbot lease
+        self.peers = {}
+        self.media = {}     # file path -> media of the first message that carried it
+        self.upload_lock = asyncio.Lock()
+        self.start_lock = asyncio.Lock()
+        # The learned pace survives restarts
+        self.governor = SendGovernor(float(get_state(conn, "userbot_send_interval", START_INTERVAL)))
+
+    async def start(self):
+        """Connect on first use. Raises if the session isn't logged in."""
+        async with self.start_lock:
+            if self.client:
+                return
+            client = get_client()
+            await client.connect()
+            if not await client.is_user_authorized():
+                await client.disconnect()
+                raise RuntimeError("Userbot session is not authorized, log in with fetch_all_entities.py")
+            self.user_id = (await client.get_me()).id
+            self.client = client
+            # So every worker can tell the account's messages apart
+            set_state(self.conn, "userbot_user_id", str(self.user_id))
+            self.conn.commit()
+            print(f"Userbot connected as {self.user_id}")
+
+    def account_id(self):
+        """The user account's id, as last seen by any worker if not connected here."""
+        if self.user_id:
+            return self.user_id
+        user_id = get_state(self.conn, "userbot_user_id")
+        return int(user_id) if user_id else None
+
+    async def stop(self):
+        if self.client:
+            await self.client.disconnect()
+            self.client = None
+
+    async def prepare(self, chat_ids):
+        """Load InputPeers for the chats, walking the dialogs only for ones the cache lacks."""
+        await self.start()
+        missing = [chat_id for chat_id in chat_ids if chat_id not in self.peers]
+        self.peers.update(load_input_peers(self.conn, missing))
+        unknown = [chat_id for chat_id in missing if chat_id not in self.peers]
+        if unknown:
+            await resolve_missing(self.client, self.conn, unknown)
+            self.peers.update(load_input_peers(self.conn, unknown))
+
+    async def request(self, chat_id, make):
+        peer = self.peers.get(chat_id)
+        if peer is None:
+            return {"ok": False, "error_code": 400, "description": "Bad Request: chat not found"}
+
+        while True:
+            try:
+                result = await make(peer)
+                self.governor.succeeded()
+                return {"ok": True, "result": result}
+            except FloodWaitError as e:
+                print(f"Userbot flood wait of {e.seconds}s in {chat_id}")
+                self.governor.flood_wait(e.seconds)
+                set_state(self.conn, "userbot_send_interval", f"{self.governor.interval:.3f}")
+                self.conn.commit()
+                if e.seconds > MAX_FLOOD_WAIT:
+                    return {
+                        "ok": False, "error_code": 429, "description": str(e),
+                        "parameters": {"retry_after": e.seconds}
+                    }
+                await self.governor.acquire()
+            except RPCError as e:
+                code = e.code or 400
+                # A server error doesn't tell whether the message went out
+                return {"ok": False, "error_code": code, "description": str(e), "unknown": code >= 500}
+
+    def call(self, chat_id, make):
+        # Called from a fan-out worker thread; waits for the loop to run it
+        return asyncio.run_coroutine_threadsafe(self.request(chat_id, make), self.loop).result()
+
+    # ---------- SENDERS ----------
+    def send_text(self, chat_id, text):
+        async def make(peer):
+            message = await self.client.send_message(peer, text)
+            return {"message_id": message.id}
+        return self.call(chat_id, make)
+
+    def send_file(self, chat_id, file_path, caption=None):
+        async def make(peer):
+            media = self.media.get(file_path)
+            if media is None:
+                # Uploaded once; later recipients reuse the sent media
+                async with self.upload_lock:
+                    media = self.media.get(file_path)
+                    if media is None:
+                        message = await self.client.send_file(peer, file_path, caption=caption or "")
+                        self.media[file_path] = message.media
+                        return {"message_id": message.id}
+            message = await self.client.send_file(peer, media, caption=caption or "")
+            return {"message_id": message.id}
+        return self.call(chat_id, make)
+
+    def send_poll(self, chat_id, question, options, correct):
+        async def make(peer):
+            poll = Poll(
+                id=0,
+                question=TextWithEntities(question, []),
+                answers=[PollAnswer(TextWithEntities(o, []), bytes([i])) for i, o in enumerate(options)],
+                hash=0,
+                quiz=True
+            )
+            message = await self.client.send_message(
+                peer, file=InputMediaPoll(poll, correct_answers=[correct])
+            )
+            return {"message_id": message.id, "poll": {"id": str(message.media.poll.id)}}
+        return self.call(chat_id, make)
+
+    def delete_messages(self, chat_id, message_ids):
+        async def make(peer):
+            await self.client.delete_messages(peer, message_ids)
+            return True
+        return self.call(chat_id, make)
+
+    # ---------- POLL RESULTS ----------
+    async def poll_results(self, chat_id, message_ids):
+        """{poll_id: [votes per option]} of the userbot's quizzes among message_ids in a chat.
+
+        Runs on the event loop. As the sender the account sees the counts
+        without voting; the reads share the governor's pace with the sends.
+        """
+        async def make(peer):
+            counts = {}
+            for message in await self.client.get_messages(peer, ids=message_ids):
+                media = getattr(message, "media", None)
+                if not isinstance(media, MessageMediaPoll) or not media.results:
+                    continue
+                votes = {r.option: r.voters for r in media.results.results or []}
+                counts[str(media.poll.id)] = [votes.get(a.option, 0) for a in media.poll.answers]
+            return counts
+
+        await self.governor.acquire()
+        response = await self.request(chat_id, make)
+        if not response["ok"]:
+            print(f"Userbot poll results in {chat_id} failed: {response['description']}")
+            return {}
+        return response["result"]
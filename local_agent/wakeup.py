@@ -0,0 +1,52 @@
+import asyncio
+import os
+import socket
+
+# Local UDP port the daemon listens on for "new job" nudges
+DAEMON_PORT = int(os.getenv("AGENT_WAKE_PORT", "47801"))
+# ... and the analytics service for "refresh now" requests
+ANALYTICS_PORT = int(os.getenv("ANALYTICS_WAKE_PORT", "47802"))
+
+
+class _WakeProtocol(asyncio.DatagramProtocol):
+    def __init__(self, event):
+        self.event = event
+
+    def datagram_received(self, data, addr):
+        self.event.set()
+
+
+def notify(port=DAEMON_PORT):
+    """Wake the process listening on port. Best effort: a no-op if nobody listens."""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.sendto(b"wake", ("127.0.0.1", port))
+    except OSError:
+        pass
+
+
+async def _poll(event, interval):
+    while True:
+        await asyncio.sleep(interval)
+        event.set()
+
+
+async def listen(port=DAEMON_PORT, fallback_poll=None):
+    """Return an asyncio.Event that gets set every time notify(port) is called.
+
+    Only one process per host can hold the port. With fallback_poll set, a
+    second one gets an event set every fallback_poll seconds instead.
+    """
+    event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.create_datagram_endpoint(
+            lambda: _WakeProtocol(event),
+            local_addr=("127.0.0.1", port)
+        )
+    except OSError:
+        if fallback_poll is None:
+            raise
+        print(f"Wake port {port} is taken by another process, polling every {fallback_poll}s")
+        event.poller = asyncio.create_task(_poll(event, fallback_poll))
+    return event
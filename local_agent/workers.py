@@ -0,0 +1,64 @@
+import os
+import socket
+from datetime import datetime, timedelta
+
+# A worker or lease not renewed for this long is considered dead
+LEASE_SECONDS = 60
+# How often a worker renews its heartbeat and leases
+HEARTBEAT_SECONDS = 15
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def lease_until():
+    return (datetime.now() + timedelta(seconds=LEASE_SECONDS)).isoformat()
+
+
+def register(conn, worker_id=WORKER_ID):
+    now = datetime.now().isoformat()
+    conn.execute("""
+        INSERT OR REPLACE INTO workers (id, host, pid, started_at, heartbeat_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, (worker_id, socket.gethostname(), os.getpid(), now, now))
+    conn.commit()
+
+
+def heartbeat(conn, worker_id=WORKER_ID):
+    """Mark the worker alive and renew the leases of its running jobs."""
+    conn.execute(
+        "UPDATE workers SET heartbeat_at = ? WHERE id = ?",
+        (datetime.now().isoformat(), worker_id)
+    )
+    conn.execute(
+        "UPDATE jobs SET lease_until = ? WHERE status = 'running' AND worker_id = ?",
+        (lease_until(), worker_id)
+    )
+    conn.commit()
+
+
+def live_count(conn):
+    cutoff = (datetime.now() - timedelta(seconds=LEASE_SECONDS)).isoformat()
+    return conn.execute("SELECT COUNT(*) FROM workers WHERE heartbeat_at >= ?", (cutoff,)).fetchone()[0]
+
+
+def acquire(conn, name, worker_id=WORKER_ID):
+    """Take or renew the named lease. True if this worker holds it now."""
+    now = datetime.now().isoformat()
+    cur = conn.execute("""
+        INSERT INTO leases (name, worker_id, lease_until) VALUES (?, ?, ?)
+        ON CONFLICT (name) DO UPDATE SET worker_id = excluded.worker_id, lease_until = excluded.lease_until
+        WHERE leases.worker_id = excluded.worker_id OR leases.lease_until < ?
+    """, (name, worker_id, lease_until(), now))
+    conn.commit()
+    return cur.rowcount > 0
+
+
+def unregister(conn, worker_id=WORKER_ID):
+    """Hand back this worker's jobs and leases on a clean shutdown."""
+    conn.execute("""
+        UPDATE jobs SET status = 'pending', worker_id = NULL, lease_until = NULL
+        WHERE status = 'running' AND worker_id = ?
+    """, (worker_id,))
+    conn.execute("DELETE FROM leases WHERE worker_id = ?", (worker_id,))
+    conn.execute("DELETE FROM workers WHERE id = ?", (worker_id,))
+    conn.commit()
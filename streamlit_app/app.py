@@ -1,11 +1,10 @@
 import streamlit as st
-import sqlite3
-import os
 import json
+import os
+import sys
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 import pandas as pd
-import subprocess
 import altair as alt
 
 # ---------------- CONFIG ----------------
@@ -16,93 +15,114 @@ st.set_page_config(
 )
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-DB_PATH = os.path.join(BASE_DIR, "local_agent", "storage.db")
 ENTITIES_PATH = os.path.join(BASE_DIR, "local_agent", "telegram_entities.json")
-TASKS_DIR = os.path.join(BASE_DIR, "local_agent", "tasks")
-
-os.makedirs(TASKS_DIR, exist_ok=True)
+UPLOADS_DIR = os.path.join(BASE_DIR, "local_agent", "uploads")
 
-# ---------------- DATABASE ----------------
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-cur = conn.cursor()
+os.makedirs(UPLOADS_DIR, exist_ok=True)
 
-# Existing tables
-cur.execute("""
-CREATE TABLE IF NOT EXISTS folders (
-    name TEXT PRIMARY KEY
-)
-""")
+# Shared job queue / schema helpers live with the agent
+sys.path.insert(0, os.path.join(BASE_DIR, "local_agent"))
+import folder_store
+import job_queue
+import message_history
+import schedular
+from db import connect, init_db, get_state
+from peer_cache import import_entities_json
+from wakeup import ANALYTICS_PORT, notify
+from workers import LEASE_SECONDS
 
-cur.execute("""
-CREATE TABLE IF NOT EXISTS folder_entities (
-    folder TEXT,
-    entity_id INTEGER,
-    label TEXT
-)
-""")
-
-# Message Logs with task_name
-cur.execute("""
-CREATE TABLE IF NOT EXISTS message_logs (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    task_id TEXT,
-    task_name TEXT,
-    task_type TEXT,
-    folders TEXT,
-    recipients INTEGER,
-    has_media INTEGER,
-    created_at TEXT
-)
-""")
-
-# Sent Messages for tracking IDs
-cur.execute("""
-CREATE TABLE IF NOT EXISTS sent_messages (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    task_id TEXT,
-    chat_id INTEGER,
-    message_id INTEGER,
-    sent_at TEXT,
-    status TEXT,
-    views INTEGER DEFAULT 0,
-    forwards INTEGER DEFAULT 0,
-    reactions INTEGER DEFAULT 0,
-    last_updated TEXT
-)
-""")
-
-# Migration for existing databases
-try:
-    cur.execute("ALTER TABLE message_logs ADD COLUMN task_name TEXT")
-except sqlite3.OperationalError:
-    pass 
-
-# Migration for sent_messages analytics
-# We must do them one by one because if one fails (column exists), the rest in the block are skipped
-migrations = [
-    "ALTER TABLE sent_messages ADD COLUMN views INTEGER DEFAULT 0",
-    "ALTER TABLE sent_messages ADD COLUMN forwards INTEGER DEFAULT 0",
-    "ALTER TABLE sent_messages ADD COLUMN reactions INTEGER DEFAULT 0",
-    "ALTER TABLE sent_messages ADD COLUMN replies INTEGER DEFAULT 0",
-    "ALTER TABLE sent_messages ADD COLUMN last_updated TEXT"
-]
-
-for cmd in migrations:
+# ---------------- DATABASE ----------------
+@st.cache_resource
+def migrate():
+    # Once per server process
+    conn = connect()
     try:
-        cur.execute(cmd)
-    except sqlite3.OperationalError:
-        pass 
-
-conn.commit()
+        init_db(conn)
+    finally:
+        conn.close()
+
+def get_connection():
+    # One connection per browser session: sqlite3 connections aren't safe
+    # to use from several sessions' script threads at once. A session's
+    # reruns run one at a time, though not always on the same thread.
+    if "conn" not in st.session_state:
+        migrate()
+        st.session_state.conn = connect(check_same_thread=False)
+    return st.session_state.conn
+
+conn = get_connection()
+cur = conn.cursor()
 
 # ---------------- LOAD ENTITIES ----------------
-with open(ENTITIES_PATH, "r", encoding="utf-8") as f:
-    entities = json.load(f)
+entities_version = get_state(conn, "entities_version")
+if entities_version is None and os.path.exists(ENTITIES_PATH):
+    # fetch_all_entities.py syncs into the entities table; the JSON export
+    # is only used to seed it once on older installs
+    import_entities_json(conn, ENTITIES_PATH)
+    entities_version = get_state(conn, "entities_version")
+
+# Rows per page in the recipient picker
+PAGE_SIZE = 50
+
+@st.cache_data(max_entries=256)
+def search_page(query, page, version):
+    # Keyed on entities_version, which every entity sync bumps. One extra
+    # row tells whether there is a next page without counting matches.
+    return folder_store.search_entities(conn, query, PAGE_SIZE + 1, page * PAGE_SIZE)
+
+def pager(key, has_next):
+    """Prev / Next buttons around a page number kept in session_state."""
+    page = st.session_state.get(key, 0)
+    c1, c2, c3 = st.columns([1, 1, 4])
+    with c1:
+        if st.button("◀ Prev", key=f"{key}_prev", disabled=page == 0):
+            st.session_state[key] = page - 1
+            st.rerun()
+    with c2:
+        if st.button("Next ▶", key=f"{key}_next", disabled=not has_next):
+            st.session_state[key] = page + 1
+            st.rerun()
+    with c3:
+        st.caption(f"Page {page + 1}")
+
+# Priority lanes of the daemon's fan-out engine
+PRIORITIES = ["urgent", "normal", "bulk"]
+PRIORITY_HELP = "Urgent sends go out ahead of running broadcasts, bulk ones yield to everything else"
+
+# Accounts the daemon can send as
+BACKENDS = {"bot": "Bot", "userbot": "My account (userbot)"}
+BACKEND_HELP = "The userbot reaches every chat in your dialogs; it is paced by Telegram's flood waits"
+
+# Recurring broadcasts, fired by the daemon's in-process scheduler
+REPEAT_OPTIONS = ["Once", "Every N hours", "Cron expression"]
+
+def repeat_picker(key):
+    """(cron, every_seconds) for a recurring broadcast, both None for a one-off."""
+    repeat = st.radio("🔁 Repeat", REPEAT_OPTIONS, horizontal=True, key=f"{key}_repeat")
+    if repeat == "Every N hours":
+        hours = st.number_input(
+            "Hours between runs", min_value=0.25, value=24.0, step=0.25, key=f"{key}_hours",
+            help="The first run goes out at the send time"
+        )
+        return None, hours * 3600
+    if repeat == "Cron expression":
+        cron = st.text_input(
+            "Cron expression", "0 9 * * *", key=f"{key}_cron",
+            help="minute hour day month weekday; 0 9 * * * is 09:00 every day"
+        )
+        return cron, None
+    return None, None
 
-ENTITY_LABELS = {
-    f"{e['name']} ({e['type']})": e["id"]
-    for e in entities
-}
+def schedule_repeat(task, cron, every_seconds, send_time, folders, excluded):
+    # Recipients are resolved from the folders again on every run
+    task = dict(task, folders=folders, exclude_folders=excluded, send_at=None)
+    start_at = None if cron else (send_time or datetime.now())
+    try:
+        schedular.add_schedule(conn, task, cron=cron, every_seconds=every_seconds, start_at=start_at)
+    except ValueError as e:
+        st.error(f"Invalid schedule: {e}")
+        return
+    st.success("Recurring broadcast scheduled, see Task Queue")
 
 # ---------------- SIDEBAR ----------------
 st.sidebar.title("📂 Navigation")
@@ -112,6 +132,7 @@ page = st.sidebar.radio(
         "Folder Manager",
         "Send Message",
         "Send / Schedule Quiz",
+        "Quiz Results",
         "Message History",
         "Data Tracking",
         "Dashboard",
@@ -137,43 +158,65 @@ if page == "Folder Manager":
 
     st.divider()
 
-    cur.execute("SELECT name FROM folders ORDER BY name")
-    folders = [f[0] for f in cur.fetchall()]
+    # Member counts for every folder in one query
+    counts = folder_store.folder_counts(conn)
+    if not counts:
+        st.info("No folders yet")
+        st.stop()
 
-    for fname in folders:
-        with st.expander(f"📁 {fname}"):
-            cur.execute(
-                "SELECT label FROM folder_entities WHERE folder=?",
-                (fname,)
-            )
-            current = [r[0] for r in cur.fetchall()]
+    fname = st.selectbox(
+        "Folder",
+        list(counts),
+        format_func=lambda f: f"📁 {f} ({counts[f]} members)"
+    )
 
-            selected = st.multiselect(
-                "Add / Remove groups & contacts",
-                ENTITY_LABELS.keys(),
-                default=current,
-                key=f"sel_{fname}"
-            )
+    tab_members, tab_add = st.tabs(["👥 Members", "➕ Add"])
 
-            c1, c2 = st.columns(2)
-            with c1:
-                if st.button("💾 Save", key=f"save_{fname}"):
-                    cur.execute("DELETE FROM folder_entities WHERE folder=?", (fname,))
-                    for label in selected:
-                        cur.execute(
-                            "INSERT INTO folder_entities VALUES (?,?,?)",
-                            (fname, ENTITY_LABELS[label], label)
-                        )
-                    conn.commit()
-                    st.success("Folder updated")
+    with tab_members:
+        mkey = f"members_page_{fname}"
+        mpage = st.session_state.get(mkey, 0)
+        rows = folder_store.folder_members(conn, fname, PAGE_SIZE + 1, mpage * PAGE_SIZE)
 
-            with c2:
-                if st.button("🗑️ Delete Folder", key=f"del_{fname}"):
-                    cur.execute("DELETE FROM folder_entities WHERE folder=?", (fname,))
-                    cur.execute("DELETE FROM folders WHERE name=?", (fname,))
-                    conn.commit()
-                    st.warning("Folder deleted")
-                    st.rerun()
+        remove = []
+        for eid, label in rows[:PAGE_SIZE]:
+            if st.checkbox(label, key=f"rm_{fname}_{eid}"):
+                remove.append(eid)
+        if not rows:
+            st.info("This folder is empty")
+
+        pager(mkey, len(rows) > PAGE_SIZE)
+
+        if st.button("➖ Remove selected", disabled=not remove):
+            folder_store.remove_members(conn, fname, remove)
+            st.success(f"Removed {len(remove)} from {fname}")
+            st.rerun()
+
+    with tab_add:
+        query = st.text_input("Search groups & contacts", key=f"q_{fname}")
+        skey = f"search_page_{fname}_{query}"
+        spage = st.session_state.get(skey, 0)
+        rows = search_page(query, spage, entities_version)
+
+        add = []
+        for eid, name, etype in rows[:PAGE_SIZE]:
+            label = folder_store.entity_label(name, etype)
+            if st.checkbox(label, key=f"add_{fname}_{eid}"):
+                add.append((eid, label))
+        if not rows:
+            st.info("No matches")
+
+        pager(skey, len(rows) > PAGE_SIZE)
+
+        if st.button("➕ Add selected", disabled=not add):
+            folder_store.add_members(conn, fname, add)
+            st.success(f"Added {len(add)} to {fname}")
+            st.rerun()
+
+    st.divider()
+    if st.button("🗑️ Delete Folder", key=f"del_{fname}"):
+        folder_store.delete_folder(conn, fname)
+        st.warning("Folder deleted")
+        st.rerun()
 
 # =========================================================
 # ✉️ SEND MESSAGE
@@ -185,6 +228,10 @@ elif page == "Send Message":
     folders = [f[0] for f in cur.fetchall()]
 
     selected_folders = st.multiselect("Select folders", folders)
+    excluded_folders = st.multiselect(
+        "Exclude folders (optional)", folders,
+        help="Members of these folders are skipped even if they are in a selected one"
+    )
     
     # NEW: Task Name
     task_name = st.text_input("Task Name (Optional)", help="Identify this broadcast in history")
@@ -203,46 +250,54 @@ elif page == "Send Message":
     with col_expire:
         expires_in = st.number_input("⏳ Temporary Message (Expires in hours)", min_value=0.0, step=0.1, help="0 to disable. Message will auto-delete after this time.")
 
+    priority = st.selectbox("Priority", PRIORITIES, index=1, help=PRIORITY_HELP)
+    backend = st.selectbox("Send as", list(BACKENDS), format_func=BACKENDS.get, help=BACKEND_HELP)
+    cron, every_seconds = repeat_picker("message")
+
     if st.button("🚀 Send Message"):
-        recipient_ids = []
-        for f in selected_folders:
-            cur.execute("SELECT entity_id FROM folder_entities WHERE folder=?", (f,))
-            recipient_ids.extend([r[0] for r in cur.fetchall()])
+        recipient_ids = folder_store.resolve_recipients(conn, selected_folders, excluded_folders)
             
         if not recipient_ids:
              st.error("No recipients found in selected folders.")
         else:
             task_id = str(uuid.uuid4())
+
+            file_path = None
+            file_type = None
+            if media:
+                ext = media.name.split(".")[-1].lower()
+                file_path = os.path.join(UPLOADS_DIR, f"{uuid.uuid4()}.{ext}")
+                with open(file_path, "wb") as f:
+                    f.write(media.getbuffer())
+                file_type = "photo" if ext in ["jpg", "jpeg", "png"] else "document"
+
             task = {
                 "type": "message",
-                "recipients": list(set(recipient_ids)),
+                "recipients": recipient_ids,
                 "content": message,
                 "send_at": send_time.isoformat() if send_time else None,
                 "media": media.name if media else None,
+                "file_path": file_path,
+                "file_type": file_type,
                 "expires_in_hours": expires_in,
-                "task_name": task_name
+                "task_name": task_name,
+                "priority": priority,
+                "backend": backend
             }
 
-            with open(os.path.join(TASKS_DIR, f"{task_id}.json"), "w") as f:
-                json.dump(task, f, indent=2)
-
-            # LOG ENTRY
-            cur.execute("""
-                INSERT INTO message_logs
-                (task_id, task_name, task_type, folders, recipients, has_media, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (
-                task_id,
-                task_name if task_name else "Untitled",
-                "message",
-                ",".join(selected_folders),
-                len(set(recipient_ids)),
-                1 if media else 0,
-                datetime.now().isoformat()
-            ))
-            conn.commit()
-
-            st.success("Message queued successfully")
+            if cron or every_seconds:
+                schedule_repeat(task, cron, every_seconds, send_time, selected_folders, excluded_folders)
+            else:
+                job_queue.enqueue(conn, task, job_id=task_id)
+
+                # LOG ENTRY
+                message_history.log_task(
+                    conn, task_id, task_name, "message",
+                    selected_folders, len(recipient_ids), media
+                )
+                conn.commit()
+
+                st.success("Message queued successfully")
 
 # =========================================================
 # 📊 QUIZ
@@ -253,23 +308,27 @@ elif page == "Send / Schedule Quiz":
     cur.execute("SELECT name FROM folders ORDER BY name")
     folders = [f[0] for f in cur.fetchall()]
     selected_folders = st.multiselect("Select folders", folders)
+    excluded_folders = st.multiselect(
+        "Exclude folders (optional)", folders,
+        help="Members of these folders are skipped even if they are in a selected one"
+    )
     
     task_name = st.text_input("Task Name (Optional)", help="Identify this quiz in history")
 
     question = st.text_input("Question")
     options = [st.text_input(f"Option {i+1}") for i in range(4)]
     correct = st.selectbox("Correct option", [0, 1, 2, 3])
+    priority = st.selectbox("Priority", PRIORITIES, index=1, help=PRIORITY_HELP)
+    backend = st.selectbox("Send as", list(BACKENDS), format_func=BACKENDS.get, help=BACKEND_HELP)
 
     schedule = st.checkbox("📅 Schedule quiz")
     send_time = datetime.now()
     if schedule:
         send_time = st.datetime_input("Send at", min_value=datetime.now())
+    cron, every_seconds = repeat_picker("quiz")
 
     if st.button("📤 Send Quiz"):
-        recipient_ids = []
-        for f in selected_folders:
-            cur.execute("SELECT entity_id FROM folder_entities WHERE folder=?", (f,))
-            recipient_ids.extend([r[0] for r in cur.fetchall()])
+        recipient_ids = folder_store.resolve_recipients(conn, selected_folders, excluded_folders)
 
         if not recipient_ids:
             st.error("No recipients found.")
@@ -277,35 +336,98 @@ elif page == "Send / Schedule Quiz":
             task_id = str(uuid.uuid4())
             task = {
                 "type": "poll",
-                "recipients": list(set(recipient_ids)),
+                "recipients": recipient_ids,
                 "content": {
                     "question": question,
                     "options": options,
                     "correct": correct
                 },
                 "send_at": send_time.isoformat(),
-                "task_name": task_name
+                "task_name": task_name,
+                "priority": priority,
+                "backend": backend
             }
 
-            with open(os.path.join(TASKS_DIR, f"{task_id}.json"), "w") as f:
-                json.dump(task, f, indent=2)
-
-            cur.execute("""
-                INSERT INTO message_logs
-                (task_id, task_name, task_type, folders, recipients, has_media, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (
-                task_id,
-                task_name if task_name else "Untitled",
-                "quiz",
-                ",".join(selected_folders),
-                len(set(recipient_ids)),
-                0,
-                datetime.now().isoformat()
-            ))
-            conn.commit()
-
-            st.success("Quiz queued successfully")
+            if cron or every_seconds:
+                schedule_repeat(task, cron, every_seconds, send_time, selected_folders, excluded_folders)
+            else:
+                job_queue.enqueue(conn, task, job_id=task_id)
+
+                message_history.log_task(
+                    conn, task_id, task_name, "quiz",
+                    selected_folders, len(recipient_ids), False
+                )
+                conn.commit()
+
+                st.success("Quiz queued successfully")
+
+# =========================================================
+# 🏆 QUIZ RESULTS
+# =========================================================
+elif page == "Quiz Results":
+    st.header("🏆 Quiz Results")
+    st.caption("Votes are collected by the agent daemon from the bot's poll updates.")
+
+    cur.execute("""
+        SELECT task_id, task_name, created_at FROM message_logs
+        WHERE task_type = 'quiz'
+        ORDER BY created_at DESC, id DESC
+        LIMIT 100
+    """)
+    quizzes = cur.fetchall()
+
+    if not quizzes:
+        st.info("No quizzes sent yet.")
+    else:
+        quiz = st.selectbox(
+            "Quiz",
+            quizzes,
+            format_func=lambda q: f"{q[1]} ({q[2][:16]})"
+        )
+
+        cur.execute("SELECT payload FROM jobs WHERE id = ?", (quiz[0],))
+        job = cur.fetchone()
+        content = json.loads(job[0])["content"] if job else {}
+        options = content.get("options", [])
+        correct = content.get("correct")
+
+        # Every recipient got its own poll; sum their votes per option
+        cur.execute("""
+            SELECT pv.option, SUM(pv.votes)
+            FROM sent_messages sm
+            JOIN poll_votes pv ON pv.poll_id = sm.poll_id
+            WHERE sm.task_id = ?
+            GROUP BY pv.option
+        """, (quiz[0],))
+        votes = dict(cur.fetchall())
+
+        cur.execute("SELECT COUNT(*) FROM sent_messages WHERE task_id = ? AND poll_id IS NOT NULL", (quiz[0],))
+        polls_sent = cur.fetchone()[0]
+
+        total = sum(votes.values())
+        right = votes.get(correct, 0)
+
+        if content.get("question"):
+            st.subheader(content["question"])
+
+        m1, m2, m3 = st.columns(3)
+        m1.metric("Chats Reached", polls_sent)
+        m2.metric("Answers", total)
+        m3.metric("Correct", f"{100 * right / total:.0f}%" if total else "-")
+
+        if options:
+            df_votes = pd.DataFrame({
+                "option": options,
+                "votes": [votes.get(i, 0) for i in range(len(options))],
+                "correct": [i == correct for i in range(len(options))]
+            })
+            chart = alt.Chart(df_votes).mark_bar().encode(
+                x="votes:Q",
+                y=alt.Y("option:N", sort=None),
+                color=alt.Color("correct:N", scale=alt.Scale(domain=[True, False], range=["#2ca02c", "#9e9e9e"])),
+                tooltip=["option", "votes"]
+            ).properties(height=250)
+            st.altair_chart(chart, use_container_width=True)
 
 # =========================================================
 # 📜 MESSAGE HISTORY
@@ -320,16 +442,24 @@ elif page == "Message History":
             ["All", "message", "quiz"]
         )
     with col2:
-        folder_filter = st.text_input("Filter by folder (optional)")
-
-    query = "SELECT * FROM message_logs ORDER BY created_at DESC"
-    df = pd.read_sql_query(query, conn)
+        folder_filter = st.selectbox(
+            "Filter by folder",
+            # The folders table is small; the log's folder mapping grows with history
+            ["All"] + [f[0] for f in conn.execute("SELECT name FROM folders ORDER BY name")]
+        )
 
-    if filter_type != "All":
-        df = df[df["task_type"] == filter_type]
+    task_type = None if filter_type == "All" else filter_type
+    folder = None if folder_filter == "All" else folder_filter
 
-    if folder_filter:
-        df = df[df["folders"].str.contains(folder_filter, case=False)]
+    # Keyset pagination: the (created_at, id) of each page's last row is the
+    # start of the next. Starting keys are kept per filter for Prev.
+    keys_name = f"history_keys_{task_type}_{folder}"
+    keys = st.session_state.setdefault(keys_name, [None])
+    rows = message_history.history_page(
+        conn, PAGE_SIZE + 1, task_type=task_type, folder=folder, before=keys[-1]
+    )
+    has_next = len(rows) > PAGE_SIZE
+    rows = rows[:PAGE_SIZE]
 
     # Custom Table Layout with Undo Button
     # Headers
@@ -343,10 +473,11 @@ elif page == "Message History":
     
     st.divider()
 
-    if df.empty:
+    if not rows:
         st.info("No message history found.")
     else:
-        for idx, row in df.iterrows():
+        for row in rows:
+            row = dict(zip(message_history.COLUMNS, row))
             c1, c2, c3, c4, c5, c6 = st.columns([2, 1, 2, 1, 1, 1])
             
             with c1:
@@ -361,36 +492,44 @@ elif page == "Message History":
                 st.write(row['created_at'])
             with c6:
                 if st.button("🗑️ Undo", key=f"undo_btn_{row['task_id']}"):
-                    # Undo Logic
-                    cur.execute("SELECT chat_id, message_id FROM sent_messages WHERE task_id = ? AND status != 'deleted'", (row['task_id'],))
-                    sent_msgs = cur.fetchall()
-                    
-                    if not sent_msgs:
+                    # Undo Logic: expire the task's live messages now, the daemon
+                    # deletes them in bulk with the temporary-message sweeper
+                    cur.execute(
+                        "UPDATE sent_messages SET expires_at = ? WHERE task_id = ? AND status = 'sent'",
+                        (datetime.now().isoformat(), row['task_id'])
+                    )
+                    conn.commit()
+                    count = cur.rowcount
+
+                    if not count:
                         st.warning("No active messages.")
                     else:
-                        count = 0
-                        for cid, mid in sent_msgs:
-                            del_task = {
-                                "type": "delete_message",
-                                "chat_id": cid,
-                                "message_id": mid,
-                                "send_at": datetime.now().isoformat()
-                            }
-                            # Queue deletion
-                            del_fname = f"undo_{uuid.uuid4()}.json"
-                            with open(os.path.join(TASKS_DIR, del_fname), "w") as f:
-                                json.dump(del_task, f)
-                            count += 1
+                        notify()
                         st.toast(f"Queued undo for {count} msgs!", icon="✅")
 
+    p1, p2, p3 = st.columns([1, 1, 4])
+    with p1:
+        if st.button("◀ Newer", disabled=len(keys) == 1):
+            keys.pop()
+            st.rerun()
+    with p2:
+        if st.button("Older ▶", disabled=not has_next):
+            keys.append((rows[-1][7], rows[-1][0]))
+            st.rerun()
+    with p3:
+        st.caption(f"Page {len(keys)}")
+
     st.divider()
-    
-    st.download_button(
-        "⬇️ Download CSV",
-        data=df.to_csv(index=False),
-        file_name="message_history.csv",
-        mime="text/csv"
-    )
+
+    # The export reads the whole filtered history, so only on request, and
+    # isn't kept in the session once downloaded
+    if st.button("📄 Prepare CSV export"):
+        st.download_button(
+            "⬇️ Download CSV",
+            data="".join(message_history.iter_csv(conn, task_type=task_type, folder=folder)),
+            file_name="message_history.csv",
+            mime="text/csv"
+        )
 
 # =========================================================
 # 📈 DATA TRACKING
@@ -399,20 +538,55 @@ elif page == "Data Tracking":
     st.header("📈 Data Tracking")
     st.caption("Fetch real-time views and forward counts from Telegram (via Userbot).")
     
+    cur.execute("SELECT value FROM sync_state WHERE key = 'analytics_last_sync'")
+    last_sync = cur.fetchone()
+    st.caption(f"Last sync: {last_sync[0] if last_sync else 'never'} · the analytics service (`python analytics_engine.py`) refreshes every few minutes")
+
     if st.button("🔄 Refresh Analytics"):
-        with st.spinner("Fetching latest stats from Telegram... (This may take a few seconds)"):
-            try:
-                # Call analytics_engine.py
-                analytics_script = os.path.join(BASE_DIR, "local_agent", "analytics_engine.py")
-                result = subprocess.run(["python", analytics_script], capture_output=True, text=True)
-                if result.returncode == 0:
-                    st.success("Analytics updated via Telethon!")
-                else:
-                    st.error(f"Failed to update: {result.stderr}")
-            except Exception as e:
-                st.error(f"Error running analytics engine: {e}")
+        # The resident analytics service picks this up without blocking the page
+        notify(ANALYTICS_PORT)
+        st.toast("Refresh requested, reload in a few seconds to see new stats.", icon="🔄")
     
     st.divider()
+
+    # Engagement over time, rebuilt from the per-sync deltas
+    st.subheader("Engagement over time")
+    cur.execute("SELECT task_id, task_name, created_at FROM message_logs ORDER BY created_at DESC, id DESC LIMIT 100")
+    recent_tasks = cur.fetchall()
+    if recent_tasks:
+        task = st.selectbox(
+            "Task",
+            recent_tasks,
+            format_func=lambda t: f"{t[1]} ({t[2][:16]})"
+        )
+        df_curve = pd.read_sql_query("""
+            SELECT strftime('%Y-%m-%d %H:00', es.ts, 'unixepoch', 'localtime') AS time,
+                   SUM(es.views) AS views, SUM(es.forwards) AS forwards,
+                   SUM(es.reactions) AS reactions, SUM(es.replies) AS comments
+            FROM sent_messages sm
+            JOIN engagement_snapshots es ON es.message_id = sm.id
+            WHERE sm.task_id = ?
+            GROUP BY 1
+            ORDER BY 1
+        """, conn, params=(task[0],))
+
+        if not df_curve.empty:
+            counters = ["views", "forwards", "reactions", "comments"]
+            df_curve[counters] = df_curve[counters].cumsum()
+            df_curve["time"] = pd.to_datetime(df_curve["time"])
+            chart = alt.Chart(
+                df_curve.melt("time", var_name="metric", value_name="total")
+            ).mark_line(point=True).encode(
+                x="time:T",
+                y="total:Q",
+                color="metric:N",
+                tooltip=["time:T", "metric:N", "total:Q"]
+            ).properties(height=300)
+            st.altair_chart(chart, use_container_width=True)
+        else:
+            st.info("No engagement recorded for this task yet.")
+
+    st.divider()
     
     # Show Table
     # Join with message_logs to get Task Name if possible
@@ -433,11 +607,19 @@ elif page == "Data Tracking":
 elif page == "Dashboard":
     st.header("📊 Dashboard")
     
-    # Metrics
-    cur.execute("SELECT COUNT(*), SUM(views), SUM(forwards), SUM(replies) FROM sent_messages WHERE status='sent'")
+    ranges = {"Last 7 days": 7, "Last 30 days": 30, "Last 90 days": 90, "All time": None}
+    range_label = st.selectbox("Time range", list(ranges), index=1)
+    days = ranges[range_label]
+    since = (datetime.now() - timedelta(days=days - 1)).date().isoformat() if days else ""
+
+    # Metrics, from the per-day rollups the sent_messages triggers keep
+    cur.execute("""
+        SELECT SUM(messages), SUM(views), SUM(forwards), SUM(replies)
+        FROM daily_stats WHERE status = 'sent' AND day >= ?
+    """, (since,))
     total_sent, total_views, total_forwards, total_comments = cur.fetchone()
-    
-    cur.execute("SELECT COUNT(*) FROM sent_messages WHERE status='deleted'")
+
+    cur.execute("SELECT SUM(messages) FROM daily_stats WHERE status = 'deleted' AND day >= ?", (since,))
     total_deleted = cur.fetchone()[0]
     
     m1, m2, m3, m4, m5 = st.columns(5)
@@ -455,14 +637,15 @@ elif page == "Dashboard":
         st.subheader("Performance by Task")
         # Top 5 Tasks by Views
         query = """
-        SELECT ml.task_name, SUM(sm.views) as total_views
-        FROM sent_messages sm
-        JOIN message_logs ml ON sm.task_id = ml.task_id
+        SELECT ml.task_name, SUM(ts.views) as total_views
+        FROM message_logs ml
+        JOIN task_stats ts ON ts.task_id = ml.task_id
+        WHERE ml.created_at >= ?
         GROUP BY ml.task_name
         ORDER BY total_views DESC
         LIMIT 10
         """
-        df_views = pd.read_sql_query(query, conn)
+        df_views = pd.read_sql_query(query, conn, params=(since,))
         
         if not df_views.empty:
             chart = alt.Chart(df_views).mark_bar().encode(
@@ -477,7 +660,12 @@ elif page == "Dashboard":
     with c2:
         st.subheader("Message Status")
         # Pie Chart of Status
-        df_status = pd.read_sql_query("SELECT status, COUNT(*) as count FROM sent_messages GROUP BY status", conn)
+        df_status = pd.read_sql_query("""
+            SELECT status, SUM(messages) as count FROM daily_stats
+            WHERE day >= ?
+            GROUP BY status
+            HAVING count > 0
+        """, conn, params=(since,))
         
         if not df_status.empty:
             chart = alt.Chart(df_status).mark_arc().encode(
@@ -495,64 +683,84 @@ elif page == "Dashboard":
 elif page == "Task Queue":
     st.header("📦 Pending Task Queue")
 
-    task_files = sorted(
-        [f for f in os.listdir(TASKS_DIR) if f.endswith(".json")],
-        reverse=True
-    )
+    # Recipient counts come straight from the JSON payload, no per-task parsing;
+    # delivery progress is counted on the deliveries (job_id, status) index
+    df = pd.read_sql_query("""
+        SELECT id AS "Task ID",
+               type AS "Type",
+               priority AS "Priority",
+               backend AS "Send As",
+               worker_id AS "Worker",
+               status AS "Status",
+               send_at AS "Scheduled At",
+               COALESCE(json_array_length(payload, '$.recipients'), 0) AS "Recipients",
+               (SELECT COUNT(*) FROM deliveries d WHERE d.job_id = jobs.id AND d.status = 'sent') AS "Sent",
+               (SELECT COUNT(*) FROM deliveries d WHERE d.job_id = jobs.id AND d.status = 'retrying') AS "Retrying",
+               (SELECT COUNT(*) FROM deliveries d WHERE d.job_id = jobs.id AND d.status = 'failed') AS "Failed"
+        FROM jobs
+        WHERE status IN ('pending', 'running')
+        ORDER BY send_at
+    """, conn)
+
+    # Daemon processes sharing this database, and whether they are alive
+    df_workers = pd.read_sql_query("""
+        SELECT id AS "Worker", started_at AS "Started", heartbeat_at AS "Last Heartbeat",
+               heartbeat_at >= strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime', ?) AS "Alive"
+        FROM workers
+        ORDER BY heartbeat_at DESC
+    """, conn, params=(f"-{LEASE_SECONDS} seconds",))
+    df_workers["Alive"] = df_workers["Alive"].astype(bool)
+    st.caption(f"{int(df_workers['Alive'].sum())} live daemon workers")
+    with st.expander("Workers"):
+        st.dataframe(df_workers, use_container_width=True)
+
+    # Recurring broadcasts; each run shows up below as an ordinary task
+    df_schedules = pd.read_sql_query("""
+        SELECT id AS "Schedule ID", name AS "Name",
+               json_extract(task, '$.type') AS "Type",
+               CASE kind WHEN 'interval' THEN 'every ' || (CAST(spec AS REAL) / 3600) || ' h'
+                         ELSE spec END AS "Repeats",
+               next_run_at AS "Next Run", last_run_at AS "Last Run",
+               enabled AS "Enabled"
+        FROM schedules
+        ORDER BY enabled DESC, next_run_at
+    """, conn)
+    df_schedules["Enabled"] = df_schedules["Enabled"].astype(bool)
+    with st.expander(f"🔁 Recurring schedules ({len(df_schedules)})"):
+        if df_schedules.empty:
+            st.info("No recurring broadcasts. Pick a repeat option when sending.")
+        else:
+            st.dataframe(df_schedules, use_container_width=True)
+            schedule_id = st.selectbox("Schedule", df_schedules["Schedule ID"].tolist())
+            enabled = bool(df_schedules.loc[df_schedules["Schedule ID"] == schedule_id, "Enabled"].iloc[0])
+            c1, c2 = st.columns(2)
+            with c1:
+                if st.button("▶️ Resume" if not enabled else "⏸️ Pause"):
+                    schedular.set_enabled(conn, schedule_id, not enabled)
+                    st.rerun()
+            with c2:
+                if st.button("🗑️ Delete Schedule"):
+                    schedular.delete_schedule(conn, schedule_id)
+                    st.rerun()
 
-    if not task_files:
+    if df.empty:
         st.info("No pending tasks in queue.")
     else:
-        rows = []
-
-        for file in task_files:
-            path = os.path.join(TASKS_DIR, file)
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    # Handle empty files potentially
-                    try:
-                        task = json.load(f)
-                    except json.JSONDecodeError:
-                        task = {}
-
-                rows.append({
-                    "Task ID": file.replace(".json", ""),
-                    "Type": task.get("type", "Unknown"),
-                    "Scheduled At": task.get("send_at") or "Immediate",
-                    "Recipients": len(task.get("recipients", [])),
-                    "File": file
-                })
-            except Exception as e:
-                rows.append({
-                    "Task ID": file,
-                    "Type": "❌ Error",
-                    "Scheduled At": str(e),
-                    "File": file
-                })
-
-        df = pd.DataFrame(rows)
-
-        st.dataframe(
-            df.drop(columns=["File"]),
-            use_container_width=True
-        )
+        st.dataframe(df, use_container_width=True)
 
         st.divider()
         st.subheader("❌ Cancel a Task")
 
-        if not df.empty:
+        pending_ids = df.loc[df["Status"] == "pending", "Task ID"].tolist()
+        if pending_ids:
             task_to_cancel = st.selectbox(
                 "Select task to cancel",
-                df["Task ID"].tolist()
+                pending_ids
             )
 
             if st.button("🗑️ Cancel Selected Task"):
-                file_name = task_to_cancel + ".json"
-                file_path = os.path.join(TASKS_DIR, file_name)
-
-                if os.path.exists(file_path):
-                    os.remove(file_path)
+                if job_queue.cancel(conn, task_to_cancel):
                     st.success(f"Task {task_to_cancel} cancelled successfully.")
                     st.rerun()
                 else:
-                    st.error("Task file not found (already processed?).")
+                    st.error("Task not found (already processed?).")